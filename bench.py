@@ -0,0 +1,270 @@
+"""Нагрузочный тест бота на локальной заглушке Telegram Bot API.
+
+Запускает настоящие обработчики из scbot.py (start, button, handle_message,
+экраны расписания и ДЗ, approve_user, рассылку объявлений) против
+HTTP-сервера, который отвечает как Bot API, и моделирует N одновременно
+работающих учеников и администратора.
+
+    python bench.py --students 200 --rounds 5 --backend sqlite
+
+Печатает пропускную способность, p50/p95/p99 задержки по шагам сценария,
+число вызовов Bot API и обращений к хранилищу на одно обновление.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import tempfile
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+
+from telegram import Update
+from telegram.ext import Application
+
+import broadcast
+import storage as storage_module
+from httpd import serve_http
+
+
+class FakeBotApi:
+    """Заглушка Bot API на httpd.serve_http: на любой метод отвечает успехом."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            lambda reader, writer: serve_http(reader, writer, self._handle, "application/json"), "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def _handle(self, http_method, path, headers, body):
+        method = path.rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return "200 OK", json.dumps({"ok": True, "result": self._result(method, headers, body)}).encode()
+
+    def _result(self, method, headers, body):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            params = {}
+            if "json" in headers.get("content-type", ""):
+                params = json.loads(body or b"{}")
+            elif "urlencoded" in headers.get("content-type", ""):
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+            chat_id = int(params.get("chat_id", 0) or 0)
+            return {"message_id": next(self._message_ids), "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        return True
+
+
+class CountingStorage(storage_module.AsyncStorage):
+    """AsyncStorage, который считает обращения к хранилищу."""
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        call = super().__getattr__(name)
+
+        async def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return await call(*args, **kwargs)
+
+        return counted
+
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id, text):
+        update_id = next(self._ids)
+        message = {"message_id": update_id, "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": update_id, "message": message}, self.bot)
+
+    def callback(self, user_id, data):
+        update_id = next(self._ids)
+        query = {"id": str(update_id), "chat_instance": "bench", "data": data, "from": self._user(user_id),
+                 "message": {"message_id": 1, "date": int(time.time()),
+                             "chat": {"id": user_id, "type": "private"}, "text": "menu"}}
+        return Update.de_json({"update_id": update_id, "callback_query": query}, self.bot)
+
+
+class Bench:
+    def __init__(self, scbot, application, updates):
+        self.scbot = scbot
+        self.application = application
+        self.updates = updates
+        self.latencies = defaultdict(list)
+
+    async def step(self, name, update):
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies[name].append(time.perf_counter() - started)
+
+    async def register(self, student):
+        await self.step("start", self.updates.message(student, "/start"))
+        await self.step("registration", self.updates.message(student, f"Ученик {student}"))
+
+    async def student_session(self, student, rounds):
+        router = self.scbot.router
+        for _ in range(rounds):
+            await self.step("schedule", self.updates.message(student, "Расписание"))
+            await self.step("homework_menu", self.updates.message(student, "Домашнее задание"))
+            await self.step("homework_day", self.updates.callback(student, router.data("hwd", "понедельник")))
+            await self.step("homework_lesson",
+                            self.updates.callback(student, router.data("hwl", "понедельник", 0)))
+            await self.step("feedback", self.updates.message(student, "Обратная связь"))
+            await self.step("feedback_text", self.updates.message(student, "Не понял задание"))
+
+    async def admin_session(self, admin, rounds):
+        router = self.scbot.router
+        for i in range(rounds):
+            await self.step("admin_menu", self.updates.message(admin, "/admin"))
+            await self.step("add_homework", self.updates.callback(admin, router.data("hwadd")))
+            await self.step("add_homework_text",
+                            self.updates.message(admin, f"понедельник:математика:стр. {i + 10} упр. 5"))
+            await self.step("view_feedback", self.updates.callback(admin, router.data("fb", 0)))
+
+
+def percentile(values, q):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="scbot-bench-")
+    os.chdir(workdir)
+
+    disk_writes = Counter()
+    write_file_atomic = storage_module.write_file_atomic
+
+    def counting_write(path, text):
+        disk_writes["json_flushes"] += 1
+        disk_writes["json_bytes"] += len(text.encode())
+        write_file_atomic(path, text)
+
+    storage_module.write_file_atomic = counting_write
+
+    journal_append = storage_module.Journal.append
+
+    def counting_append(journal, record):
+        disk_writes["journal_appends"] += 1
+        journal_append(journal, record)
+
+    storage_module.Journal.append = counting_append
+
+    # scbot открывает хранилище при импорте, поэтому импортируем его уже
+    # во временном каталоге, чтобы не трогать настоящий data.json
+    import scbot
+
+    backend = storage_module.open_storage(args.backend)
+    if isinstance(backend, storage_module.SqliteStorage):
+        def trace(statement):
+            if statement.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
+                disk_writes["sqlite_writes"] += 1
+
+        backend.add_class(scbot.DEFAULT_CLASS)
+        backend.conn.set_trace_callback(trace)
+        backend.shard(scbot.DEFAULT_CLASS).conn.set_trace_callback(trace)
+    await scbot.storage.close()
+    scbot.storage = CountingStorage(backend)
+
+    scbot.METRICS_PORT = 0
+    scbot.METRICS_LOG_INTERVAL = 0
+
+    api = FakeBotApi(latency=args.api_latency / 1000)
+    await api.start()
+    application = scbot.build_application(Application.builder().token("1:bench").base_url(api.base_url))
+    updates = UpdateFactory(application.bot)
+    bench = Bench(scbot, application, updates)
+    admin = scbot.ADMIN_ID
+    students = [1000 + i for i in range(args.students)]
+
+    async with application:
+        await scbot.post_init(application)
+        application.bot_data['broadcaster'].bucket = broadcast.TokenBucket(args.broadcast_rate)
+        await scbot.storage.set_schedule_day(scbot.DEFAULT_CLASS, "понедельник", ["математика", "русский", "литература"])
+        await scbot.storage.set_homework(scbot.DEFAULT_CLASS, "понедельник", "математика", "стр. 12 упр. 5")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(bench.register(student) for student in students))
+        for student in students:
+            await bench.step("approve_user", updates.callback(admin, scbot.router.data("ap", scbot.DEFAULT_CLASS, student)))
+        await asyncio.gather(
+            bench.admin_session(admin, args.rounds),
+            *(bench.student_session(student, args.rounds) for student in students),
+        )
+        elapsed = time.perf_counter() - started
+
+        broadcast_started = time.perf_counter()
+        await bench.step("announcement", updates.callback(admin, scbot.router.data("ann")))
+        await bench.step("announcement_text", updates.message(admin, "Завтра уроки отменяются"))
+        while await scbot.storage.list_broadcasts():
+            await asyncio.sleep(0.05)
+        broadcast_elapsed = time.perf_counter() - broadcast_started
+
+        await scbot.post_stop(application)
+        await scbot.post_shutdown(application)
+    await api.stop()
+
+    handled = sum(len(values) for values in bench.latencies.values())
+    print(f"backend={args.backend} students={args.students} rounds={args.rounds} "
+          f"api_latency={args.api_latency}ms workdir={workdir}")
+    print(f"updates: {handled}, elapsed: {elapsed:.2f}s, throughput: {handled / elapsed:.1f} updates/s")
+    print(f"broadcast to {len(students) + 1} users: {broadcast_elapsed:.2f}s")
+    print()
+    print(f"{'step':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in bench.latencies.items():
+        print(f"{name:<20}{len(values):>8}{percentile(values, 50) * 1000:>10.2f}"
+              f"{percentile(values, 95) * 1000:>10.2f}{percentile(values, 99) * 1000:>10.2f}")
+    print()
+    print("Bot API calls:", dict(api.calls))
+    storage_calls = sum(scbot.storage.calls.values())
+    print(f"storage calls: {storage_calls} ({storage_calls / handled:.2f} per update)", dict(scbot.storage.calls))
+    print("storage disk writes:", dict(disk_writes),
+          f"({sum(v for k, v in disk_writes.items() if not k.endswith('bytes')) / handled:.3f} per update)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=30, help="число одновременно работающих учеников")
+    parser.add_argument("--rounds", type=int, default=3, help="сколько раз каждый ученик проходит сценарий")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--broadcast-rate", type=float, default=1000.0,
+                        help="лимит рассылки, сообщений/с (в реальном боте broadcast.GLOBAL_RATE)")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from metrics import metrics
+
+GLOBAL_RATE = 25  # Сообщений в секунду на всего бота (лимит Telegram ~30)
+PER_CHAT_INTERVAL = 1.0  # Не чаще одного сообщения в секунду в один чат
+MAX_ATTEMPTS = 5  # Попыток доставки одному получателю при сетевых ошибках
+CHECKPOINT_EVERY = 50  # Как часто сохранять прогресс рассылки в хранилище
+PROGRESS_INTERVAL = 30.0  # Как часто (в секундах) сообщать админу о прогрессе
+
+
+async def wait_stopped(stop, delay):
+    """Ждёт delay секунд или события stop, что наступит раньше.
+    True, если бот останавливается."""
+    try:
+        await asyncio.wait_for(stop.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+    return stop.is_set()
+
+
+class TokenBucket:
+    """Token bucket для asyncio: не больше rate операций в секунду
+    с допустимым всплеском до capacity. Ожидающие обслуживаются по очереди."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcaster:
+    """Фоновая рассылка объявлений.
+
+    Рассылки хранятся в storage (create_broadcast/update_broadcast), поэтому
+    после перезапуска бот продолжает рассылку с сохранённой позиции.
+    Отправка ограничена общим token bucket и интервалом на чат; RetryAfter
+    и сетевые ошибки повторяются с ожиданием, а пользователи,
+    заблокировавшие бота, удаляются из списка пользователей.
+
+    Если рассылки ставят в очередь другие процессы бота, задайте
+    poll_interval: тогда очередь проверяется и без сигнала от submit().
+    """
+
+    def __init__(self, bot, storage, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL, poll_interval=None):
+        self.bot = bot
+        self.storage = storage
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.poll_interval = poll_interval
+        self._last_sent = {}
+        self._remaining = {}  # id рассылки -> сколько получателей осталось
+        self._wakeup = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._stop.clear()
+            self._task = asyncio.create_task(self._run(), name="broadcaster")
+
+    async def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def submit(self, text, admin_id, class_id=None):
+        """Ставит объявление в очередь: пользователям класса class_id или всем."""
+        recipients = await self.storage.list_users(class_id)
+        broadcast_id = await self.storage.create_broadcast(text, admin_id, recipients)
+        self._wakeup.set()
+        return broadcast_id
+
+    async def _run(self):
+        while not self._stop.is_set():
+            broadcasts = await self.storage.list_broadcasts()
+            self._remaining = {b['id']: len(b['recipients']) - b['position'] for b in broadcasts}
+            self._report_depth()
+            if not broadcasts:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            for broadcast in broadcasts:
+                if self._stop.is_set():
+                    return
+                try:
+                    await self._process(broadcast)
+                except Exception as e:
+                    logging.error(f"Error in broadcast {broadcast['id']}: {e}", exc_info=True)
+                    await wait_stopped(self._stop, PROGRESS_INTERVAL)
+
+    async def _process(self, broadcast):
+        recipients = broadcast['recipients']
+        position = broadcast['position']
+        sent, failed, pruned = broadcast['sent'], broadcast['failed'], broadcast['pruned']
+        text = f"Новое объявление от администратора:\n{broadcast['text']}"
+        last_report = time.monotonic()
+
+        while position < len(recipients):
+            result = "stopped" if self._stop.is_set() else await self.deliver(recipients[position], text)
+            if result == "stopped":
+                # Получатель не обработан: после перезапуска рассылка продолжится с него
+                await self.storage.update_broadcast(broadcast['id'], position, sent, failed, pruned)
+                return
+            metrics.inc("broadcast_messages_total", result=result)
+            if result == "sent":
+                sent += 1
+            else:
+                failed += 1
+                if result == "blocked":
+                    await self.storage.remove_user(recipients[position])
+                    pruned += 1
+            position += 1
+            self._remaining[broadcast['id']] = len(recipients) - position
+            self._report_depth()
+
+            if position % CHECKPOINT_EVERY == 0:
+                await self.storage.update_broadcast(broadcast['id'], position, sent, failed, pruned)
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await self._notify(broadcast['admin_id'],
+                                   f"Рассылка #{broadcast['id']}: обработано {position} из {len(recipients)}")
+
+        await self.storage.finish_broadcast(broadcast['id'])
+        self._last_sent.clear()
+        await self._notify(broadcast['admin_id'],
+                           f"Рассылка #{broadcast['id']} завершена: доставлено {sent}, не доставлено {failed}, "
+                           f"удалено заблокировавших бота {pruned}")
+
+    def _report_depth(self):
+        metrics.set_gauge("broadcast_queue_depth", sum(self._remaining.values()))
+
+    async def deliver(self, chat_id, text):
+        """Отправляет одно сообщение под общим лимитом рассылок.
+        Возвращает "sent", "failed", "blocked" (бот заблокирован) или
+        "stopped" (бот останавливается, сообщение не отправлено)."""
+        for attempt in range(MAX_ATTEMPTS):
+            await self._throttle(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return "sent"
+            except RetryAfter as e:
+                logging.warning(f"Flood limit hit while broadcasting, sleeping {e.retry_after}s")
+                if await wait_stopped(self._stop, e.retry_after):
+                    return "stopped"
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                logging.error(f"Broadcast to {chat_id} failed: {e}")
+                return "failed"
+            except (TimedOut, NetworkError) as e:
+                delay = 2 ** attempt
+                logging.warning(f"Network error while broadcasting to {chat_id}: {e}, retry in {delay}s")
+                if await wait_stopped(self._stop, delay):
+                    return "stopped"
+        return "failed"
+
+    async def _throttle(self, chat_id):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            wait = self.per_chat_interval - (time.monotonic() - last)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        await self.bucket.acquire()
+        self._last_sent[chat_id] = time.monotonic()
+
+    async def _notify(self, admin_id, text):
+        try:
+            await self.bucket.acquire()
+            await self.bot.send_message(chat_id=admin_id, text=text)
+        except Exception as e:
+            logging.error(f"Failed to report broadcast progress: {e}")
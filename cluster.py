@@ -0,0 +1,405 @@
+"""Несколько процессов бота над общей базой SQLite.
+
+    python scbot.py workers 4
+
+Главный процесс получает обновления от Telegram (webhook или long polling)
+и пересылает каждое одному из рабочих процессов по id пользователя:
+обновления одного пользователя всегда попадают в один процесс и
+обрабатываются по очереди, а разные пользователи распределяются по ядрам.
+Если рабочий процесс упал, его пользователи переходят к остальным, пока
+Supervisor его перезапускает. Рассылки и напоминания выполняет тот
+процесс, который держит аренду в базе (Lease).
+
+Рабочие процессы принимают обновления только с заголовком X-Worker-Token:
+случайный токен главный процесс создаёт при запуске и передаёт рабочим
+через переменную окружения WORKER_TOKEN_ENV.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import ssl
+
+import httpx
+from telegram import Update
+from telegram.error import InvalidToken, NetworkError, RetryAfter, TelegramError
+
+from httpd import serve_http
+from metrics import metrics
+
+FORWARD_TIMEOUT = 10.0  # Сколько ждать, пока рабочий процесс примет обновление
+HEALTH_INTERVAL = 2.0  # Как часто проверять, поднялся ли упавший рабочий процесс
+RESTART_DELAY = 1.0  # Пауза перед перезапуском упавшего рабочего процесса
+STOP_TIMEOUT = 15.0  # Сколько ждать завершения рабочих процессов при остановке
+LEASE_TTL = 30.0  # Через сколько секунд аренду упавшего процесса забирает другой
+POLL_TIMEOUT = 30  # Long polling: сколько секунд Telegram держит запрос getUpdates
+POLL_ERROR_DELAY = 5.0  # Пауза после ошибки getUpdates, кроме сетевых (например, Conflict)
+WORKER_TOKEN_ENV = "SCBOT_WORKER_TOKEN"  # Переменная окружения с токеном рабочих процессов
+WORKER_TOKEN_HEADER = "X-Worker-Token"  # Заголовок, которым главный процесс подписывает обновления
+
+
+def user_id_of(update):
+    """id пользователя, от которого пришло обновление (словарь в формате Bot API), или 0."""
+    for value in update.values():
+        if isinstance(value, dict):
+            for field in ("from", "user", "chat"):
+                if isinstance(value.get(field), dict) and "id" in value[field]:
+                    return value[field]["id"]
+    return 0
+
+
+def _score(user_id, worker):
+    return hashlib.blake2b(f"{user_id}:{worker}".encode(), digest_size=8).digest()
+
+
+def workers_for(user_id, workers):
+    """Рабочие процессы в порядке предпочтения для пользователя (rendezvous hashing):
+    когда процесс падает, к другим переходят только его пользователи."""
+    return sorted(workers, key=lambda worker: _score(user_id, worker), reverse=True)
+
+
+class Dispatcher:
+    """Принимает обновления и отдаёт каждое рабочему процессу его пользователя.
+
+    Если процесс не принял обновление, он считается упавшим и обновление
+    получает следующий по порядку (workers_for). Упавшие процессы
+    проверяются раз в HEALTH_INTERVAL и возвращаются в работу, как только
+    отвечают на /health.
+    """
+
+    def __init__(self, host, ports, token):
+        self.urls = {index: f"http://{host}:{port}" for index, port in enumerate(ports)}
+        self.token = token
+        self.alive = set()
+        self._client = None
+        self._server = None
+        self._path = None
+        self._secret = None
+        self._tasks = []
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=FORWARD_TIMEOUT)
+        self._tasks.append(asyncio.create_task(self._health_loop(), name="cluster-health"))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._client.aclose()
+
+    def mark_down(self, index):
+        if index in self.alive:
+            self.alive.discard(index)
+            logging.warning(f"Worker {index} is down, its users move to other workers")
+        metrics.set_gauge("cluster_workers_alive", len(self.alive))
+
+    async def _health_loop(self):
+        while True:
+            for index, url in self.urls.items():
+                if index in self.alive:
+                    continue
+                try:
+                    response = await self._client.get(f"{url}/health", timeout=1.0)
+                except httpx.HTTPError:
+                    continue
+                if response.status_code == 200:
+                    self.alive.add(index)
+                    logging.info(f"Worker {index} is up")
+            metrics.set_gauge("cluster_workers_alive", len(self.alive))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def forward(self, body, user_id):
+        """Отдаёт обновление (тело запроса Telegram) рабочему процессу. False, если не принял ни один."""
+        for index in workers_for(user_id, self.alive):
+            try:
+                response = await self._client.post(
+                    f"{self.urls[index]}/update", content=body,
+                    headers={"Content-Type": "application/json", WORKER_TOKEN_HEADER: self.token})
+                if response.status_code == 200:
+                    metrics.inc("cluster_updates_total", worker=index)
+                    return True
+                logging.warning(f"Worker {index} rejected an update: {response.status_code}")
+            except httpx.HTTPError as e:
+                logging.warning(f"Failed to forward an update to worker {index}: {e}")
+            self.mark_down(index)
+        metrics.inc("cluster_updates_rejected_total")
+        return False
+
+    async def serve_webhook(self, listen, port, path, secret=None, cert=None, key=None):
+        ssl_context = None
+        if cert:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(cert, key)
+        self._path = "/" + path.lstrip("/")
+        self._secret = secret
+        self._server = await asyncio.start_server(
+            lambda reader, writer: serve_http(reader, writer, self._webhook), listen, port, ssl=ssl_context)
+
+    async def _webhook(self, method, path, headers, body):
+        if method != "POST" or path != self._path:
+            return "404 Not Found", b""
+        if self._secret and headers.get("x-telegram-bot-api-secret-token") != self._secret:
+            return "403 Forbidden", b""
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return "400 Bad Request", b""
+        if not isinstance(update, dict):
+            return "400 Bad Request", b""
+        # Если не принял ни один процесс, Telegram повторит обновление позже
+        if await self.forward(body, user_id_of(update)):
+            return "200 OK", b""
+        return "503 Service Unavailable", b""
+
+    async def poll(self, bot):
+        """Long polling: обновление подтверждается Telegram только после того,
+        как его принял рабочий процесс. Неверный токен завершает poll с ошибкой,
+        остальные ошибки повторяются с паузой."""
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                                allowed_updates=Update.ALL_TYPES)
+            except InvalidToken:
+                raise
+            except RetryAfter as e:
+                logging.warning(f"getUpdates flood limit, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except NetworkError as e:
+                logging.warning(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            except TelegramError as e:
+                # Например, Conflict: обновления забирает другой экземпляр бота
+                logging.error(f"getUpdates failed: {e}, retrying in {POLL_ERROR_DELAY}s")
+                await asyncio.sleep(POLL_ERROR_DELAY)
+                continue
+            for update in updates:
+                data = update.to_dict()
+                body = json.dumps(data).encode()
+                while not await self.forward(body, user_id_of(data)):
+                    await asyncio.sleep(HEALTH_INTERVAL)
+                offset = update.update_id + 1
+
+
+class Supervisor:
+    """Держит запущенными count рабочих процессов; command(index) — команда запуска.
+    Токен dispatcher.token передаётся процессам в переменной WORKER_TOKEN_ENV."""
+
+    def __init__(self, dispatcher, command, count):
+        self.dispatcher = dispatcher
+        self.command = command
+        self.count = count
+        self._env = {**os.environ, WORKER_TOKEN_ENV: dispatcher.token}
+        self._processes = {}
+        self._tasks = []
+        self._stopping = False
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._keep(index), name=f"worker-{index}")
+                       for index in range(self.count)]
+
+    async def stop(self):
+        self._stopping = True
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._tasks), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("Workers did not stop in time, killing them")
+            for process in self._processes.values():
+                if process.returncode is None:
+                    process.kill()
+            await asyncio.gather(*self._tasks)
+
+    async def _keep(self, index):
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(*self.command(index), env=self._env)
+            self._processes[index] = process
+            code = await process.wait()
+            self.dispatcher.mark_down(index)
+            if self._stopping:
+                break
+            logging.error(f"Worker {index} exited with code {code}, restarting in {RESTART_DELAY}s")
+            metrics.inc("cluster_worker_restarts_total")
+            await asyncio.sleep(RESTART_DELAY)
+
+
+def _poller_done(task, stop):
+    # Без получения обновлений кластер бесполезен: останавливаем его целиком
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Polling stopped, shutting down workers", exc_info=task.exception())
+        stop.set()
+
+
+def _stop_event():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def run_cluster(bot, count, command, worker_host, worker_base_port, metrics_server,
+                      webhook_url=None, listen=None, port=None, path=None, secret=None, cert=None, key=None):
+    """Главный процесс: запускает рабочие процессы и раздаёт им обновления.
+    Без webhook_url обновления получаются через long polling."""
+    stop = _stop_event()
+    dispatcher = Dispatcher(worker_host, [worker_base_port + index for index in range(count)],
+                            secrets.token_urlsafe(32))
+    supervisor = Supervisor(dispatcher, command, count)
+    await dispatcher.start()
+    supervisor.start()
+    # Если запуск не удался (порт занят, Telegram отказал), рабочие процессы
+    # всё равно останавливаются: иначе они держали бы порты и аренду рассылок
+    try:
+        await metrics_server.start()
+        async with bot:
+            poller = None
+            if webhook_url:
+                await dispatcher.serve_webhook(listen, port, path, secret, cert, key)
+                certificate = open(cert, "rb") if cert else None
+                try:
+                    await bot.set_webhook(url=webhook_url, certificate=certificate, secret_token=secret,
+                                          allowed_updates=Update.ALL_TYPES)
+                finally:
+                    if certificate is not None:
+                        certificate.close()
+            else:
+                await bot.delete_webhook()
+                poller = asyncio.create_task(dispatcher.poll(bot), name="cluster-poll")
+                poller.add_done_callback(lambda task: _poller_done(task, stop))
+            logging.info(f"Started {count} workers")
+
+            await stop.wait()
+            if poller is not None:
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        await dispatcher.stop()
+        await supervisor.stop()
+        await metrics_server.stop()
+
+
+class WorkerServer:
+    """HTTP-вход рабочего процесса: POST /update ставит обновление в очередь Application.
+    Обновления без верного токена в заголовке WORKER_TOKEN_HEADER отклоняются."""
+
+    def __init__(self, application, host, port, token):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.token = token
+        self.accepting = False
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            lambda reader, writer: serve_http(reader, writer, self._handle), self.host, self.port)
+        self.accepting = True
+
+    async def stop(self):
+        # Новые обновления сразу уходят другим процессам, а принятые ещё обрабатываются
+        self.accepting = False
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, method, path, headers, body):
+        if path == "/health":
+            return ("200 OK" if self.accepting else "503 Service Unavailable"), b""
+        if method != "POST" or path != "/update":
+            return "404 Not Found", b""
+        # Порт рабочего процесса доступен и другим локальным программам:
+        # без токена любая из них могла бы подделать обновление от админа
+        if not hmac.compare_digest(headers.get(WORKER_TOKEN_HEADER.lower(), "").encode(), self.token.encode()):
+            return "403 Forbidden", b""
+        if not self.accepting:
+            return "503 Service Unavailable", b""
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError):
+            return "400 Bad Request", b""
+        await self.application.update_queue.put(update)
+        return "200 OK", b""
+
+
+async def run_worker(application, host, port):
+    """Рабочий процесс: Application без собственного получения обновлений.
+    Запускается главным процессом (run_cluster), от него же получает токен."""
+    token = os.environ.get(WORKER_TOKEN_ENV)
+    if not token:
+        raise RuntimeError(f"{WORKER_TOKEN_ENV} is not set: workers are started by the main process")
+    stop = _stop_event()
+    server = WorkerServer(application, host, port, token)
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        await server.start()
+        logging.info(f"Worker listening on {host}:{port}")
+
+        await stop.wait()
+        await server.stop()
+        await application.stop()
+        await application.post_stop(application)
+        await application.post_shutdown(application)
+
+
+class Lease:
+    """Аренда name в общем хранилище: её держит один процесс из всех.
+
+    Пока аренда у этого процесса, работает то, что запускает on_acquire
+    (рассылки, напоминания); при потере аренды вызывается on_release.
+    Аренда продлевается каждые ttl/3 секунд, а аренду упавшего процесса
+    через ttl секунд забирает другой.
+    """
+
+    def __init__(self, storage, name, on_acquire, on_release, ttl=LEASE_TTL):
+        self.storage = storage
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.ttl = ttl
+        self.held = False
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"lease-{self.name}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.held:
+            self.held = False
+            await self.on_release()
+            await self.storage.release_lease(self.name, self.owner)
+
+    async def _run(self):
+        while True:
+            try:
+                held = await self.storage.acquire_lease(self.name, self.owner, self.ttl)
+            except Exception as e:
+                logging.error(f"Failed to renew lease {self.name}: {e}", exc_info=True)
+                held = False
+            if held and not self.held:
+                logging.info(f"Lease {self.name} acquired by {self.owner}")
+                self.held = True
+                await self.on_acquire()
+            elif not held and self.held:
+                logging.warning(f"Lease {self.name} lost by {self.owner}")
+                self.held = False
+                await self.on_release()
+            await asyncio.sleep(self.ttl / 3)
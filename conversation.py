@@ -0,0 +1,80 @@
+import enum
+import logging
+import time
+
+CONVERSATION_TTL = 24 * 60 * 60  # Сколько секунд бот ждёт ответа в начатом диалоге
+
+
+class State(enum.Enum):
+    """Шаг диалога: чего бот ждёт от пользователя следующим сообщением."""
+
+    REGISTRATION = "registration"  # Имя и фамилия; параметр — выбранный класс
+    FEEDBACK = "feedback"  # Сообщение для администратора
+    SCHEDULE = "schedule"  # Расписание на день (админ)
+    HOMEWORK = "homework"  # ДЗ (админ)
+    ANNOUNCEMENT = "announcement"  # Текст объявления (админ)
+    FEEDBACK_REPLY = "feedback_reply"  # Ответ на обратную связь (админ); параметр — "класс:id сообщения"
+    IMPORT = "import"  # Файл с расписанием и ДЗ (админ)
+
+
+class Conversations:
+    """Текущий шаг диалога каждого пользователя: одно состояние State
+    и его параметр.
+
+    Состояния сохраняются в storage и загружаются при старте (restore),
+    поэтому перезапуск бота не обрывает начатые диалоги. В памяти лежит
+    копия, и обработчик сообщения находит шаг диалога одним обращением
+    к словарю. Диалог, в котором пользователь не ответил за ttl секунд,
+    считается брошенным.
+
+    С cached=False копии в памяти нет и состояние каждый раз читается из
+    storage: так работают несколько процессов бота, между которыми
+    пользователь может перейти, если его процесс упал.
+    """
+
+    def __init__(self, storage, ttl=CONVERSATION_TTL, cached=True):
+        self.storage = storage
+        self.ttl = ttl
+        self.cached = cached
+        self._states = {}  # id пользователя -> (State, параметр, срок действия)
+
+    async def restore(self):
+        if not self.cached:
+            return 0
+        purged = await self.storage.purge_conversations(time.time())
+        self._states = {}
+        for user_id, state, arg, expires in await self.storage.list_conversations():
+            try:
+                self._states[user_id] = (State(state), arg, expires)
+            except ValueError:
+                logging.warning(f"Unknown conversation state {state!r} for user {user_id}, dropped")
+        logging.info(f"Restored {len(self._states)} conversations, {purged} expired")
+        return len(self._states)
+
+    async def get(self, user_id):
+        """(State, параметр) или (None, None), если бот ничего не ждёт от пользователя."""
+        if self.cached:
+            entry = self._states.get(user_id)
+        else:
+            entry = await self.storage.get_conversation(user_id)
+            if entry is not None:
+                try:
+                    entry = (State(entry[0]), entry[1], entry[2])
+                except ValueError:
+                    entry = None
+        if entry is None:
+            return None, None
+        if entry[2] < time.time():
+            self._states.pop(user_id, None)
+            return None, None
+        return entry[0], entry[1]
+
+    async def set(self, user_id, state, arg=None):
+        expires = time.time() + self.ttl
+        if self.cached:
+            self._states[user_id] = (state, arg, expires)
+        await self.storage.set_conversation(user_id, state.value, arg, expires)
+
+    async def finish(self, user_id):
+        self._states.pop(user_id, None)
+        await self.storage.set_conversation(user_id, None)
@@ -0,0 +1,39 @@
+"""Минимальный HTTP/1.1 сервер на asyncio для внутренних эндпоинтов бота:
+webhook и вход рабочих процессов (cluster.py), /metrics (metrics.py),
+заглушка Bot API (bench.py)."""
+import asyncio
+
+MAX_REQUEST_SIZE = 1024 * 1024  # Больше Telegram не присылает
+
+
+async def serve_http(reader, writer, handle, content_type="text/plain"):
+    """Обслуживает одно соединение с keep-alive.
+
+    handle(метод, путь, заголовки, тело) -> (статус, тело ответа); имена
+    заголовков приводятся к нижнему регистру, путь — без query string.
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or length > MAX_REQUEST_SIZE:
+                status, body = "400 Bad Request", b""
+            else:
+                request_body = await reader.readexactly(length)
+                status, body = await handle(parts[0], parts[1].split("?")[0], headers, request_body)
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            if status == "400 Bad Request":
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
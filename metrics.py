@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+from httpd import serve_http
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOG_SAMPLE_RATE = 0.01  # Доля обновлений, попадающих в отладочный лог
+
+logger = logging.getLogger("scbot")
+
+
+class Metrics:
+    """Счётчики, gauge и гистограммы задержек в памяти процесса.
+
+    Значения отдаются в текстовом формате Prometheus (render) и короткой
+    сводкой для периодического лога (summary).
+    """
+
+    def __init__(self, prefix="scbot"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._values = {}  # (name, labels) -> число или [bucket_counts, sum, count]
+
+    def _key(self, name, kind, labels):
+        known = self._types.setdefault(name, kind)
+        if known != kind:
+            raise ValueError(f"Metric {name} is a {known}, not a {kind}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = self._key(name, "counter", labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self._values[self._key(name, "gauge", labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            key = self._key(name, "histogram", labels)
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if index < len(LATENCY_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def timed(self, func):
+        """Декоратор обработчика: пишет его задержку в handler_seconds."""
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.observe("handler_seconds", time.perf_counter() - started, handler=func.__name__)
+
+        return wrapper
+
+    def render(self):
+        lines = []
+        with self.lock:
+            items = sorted(self._values.items(), key=lambda item: item[0])
+            types = dict(self._types)
+        current = None
+        for (name, labels), value in items:
+            full_name = f"{self.prefix}_{name}"
+            if name != current:
+                current = name
+                lines.append(f"# TYPE {full_name} {types[name]}")
+            if types[name] != "histogram":
+                lines.append(f"{full_name}{_labels(labels)} {value}")
+                continue
+            buckets, total, count = value
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f"{full_name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{full_name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{full_name}_sum{_labels(labels)} {total}")
+            lines.append(f"{full_name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        parts = []
+        with self.lock:
+            for (name, labels), value in sorted(self._values.items(), key=lambda item: item[0]):
+                label = ",".join(f"{k}={v}" for k, v in labels)
+                label = f"{name}[{label}]" if label else name
+                if self._types[name] == "histogram":
+                    _, total, count = value
+                    if count:
+                        parts.append(f"{label}: n={count} avg={total / count * 1000:.1f}ms")
+                else:
+                    parts.append(f"{label}: {value}")
+        return "; ".join(parts)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+metrics = Metrics()
+timed = metrics.timed
+
+
+def sampled_log(event, **fields):
+    """Структурный лог события для небольшой доли обновлений
+    (вместо print() на каждое нажатие)."""
+    if random.random() < LOG_SAMPLE_RATE:
+        logger.info(json.dumps({"event": event, **fields}, ensure_ascii=False))
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API, их задержку и ошибки."""
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("api_errors_total", method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.inc("api_calls_total", method=method)
+            metrics.observe("api_seconds", time.perf_counter() - started, method=method)
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics в формате Prometheus и периодическая сводка в лог."""
+
+    def __init__(self, host, port, log_interval):
+        self.host = host
+        self.port = port
+        self.log_interval = log_interval
+        self._server = None
+        self._log_task = None
+
+    async def start(self):
+        if self.port:
+            self._server = await asyncio.start_server(
+                lambda reader, writer: serve_http(reader, writer, self._handle, "text/plain; version=0.0.4"),
+                self.host, self.port)
+        if self.log_interval:
+            self._log_task = asyncio.create_task(self._log_loop(), name="metrics-log")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._log_task is not None:
+            self._log_task.cancel()
+
+    async def _handle(self, method, path, headers, body):
+        if path == "/metrics":
+            return "200 OK", metrics.render().encode()
+        return "404 Not Found", b"not found\n"
+
+    async def _log_loop(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            logger.info(f"Metrics: {metrics.summary()}")
@@ -0,0 +1,89 @@
+import asyncio
+import datetime
+import logging
+from collections import defaultdict
+
+from broadcast import wait_stopped
+from metrics import metrics
+
+WEEKDAYS = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+MAX_CATCH_UP = 60  # За сколько минут отправляются пропущенные напоминания (если бот был занят)
+
+
+def tomorrow(moment):
+    """Название дня недели, следующего за moment, как в расписании."""
+    return WEEKDAYS[(moment.weekday() + 1) % 7]
+
+
+class ReminderScheduler:
+    """Ежедневные напоминания о расписании и ДЗ на завтра.
+
+    Раз в минуту берёт из storage пользователей, подписанных на это время
+    (set_reminder), и группирует их по классам. Текст напоминания строится
+    функцией render(class_id, day) один раз на класс и день, а отправляется
+    через Broadcaster.deliver — под тем же лимитом, что и объявления.
+    Время — местное время сервера.
+    """
+
+    def __init__(self, storage, broadcaster, render):
+        self.storage = storage
+        self.broadcaster = broadcaster
+        self.render = render
+        self._stop = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._stop.clear()
+            self._task = asyncio.create_task(self._run(), name="reminders")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        last = datetime.datetime.now().replace(second=0, microsecond=0)
+        while not self._stop.is_set():
+            now = datetime.datetime.now()
+            await wait_stopped(self._stop, 60 - now.second - now.microsecond / 1_000_000)
+            current = datetime.datetime.now().replace(second=0, microsecond=0)
+            # Если рассылка заняла больше минуты, догоняем пропущенные минуты
+            last = max(last, current - datetime.timedelta(minutes=MAX_CATCH_UP))
+            while last < current and not self._stop.is_set():
+                last += datetime.timedelta(minutes=1)
+                try:
+                    await self.send_reminders(last)
+                except Exception as e:
+                    logging.error(f"Error while sending reminders for {last:%H:%M}: {e}", exc_info=True)
+
+    async def send_reminders(self, moment):
+        """Отправляет напоминания, назначенные на время moment. Возвращает число доставленных."""
+        users = await self.storage.list_reminder_users(moment.strftime("%H:%M"))
+        if not users:
+            return 0
+
+        classes = defaultdict(list)
+        for user_id, class_id in users:
+            classes[class_id].append(user_id)
+
+        day = tomorrow(moment)
+        sent = 0
+        for class_id, recipients in classes.items():
+            text = await self.render(class_id, day)
+            if text is None:
+                continue
+            for user_id in recipients:
+                if self._stop.is_set():
+                    return sent
+                result = await self.broadcaster.deliver(user_id, text)
+                if result == "stopped":
+                    return sent
+                metrics.inc("reminder_messages_total", result=result)
+                if result == "sent":
+                    sent += 1
+                elif result == "blocked":
+                    await self.storage.remove_user(user_id)
+        logging.info(f"Sent {sent} reminders for {moment:%H:%M}")
+        return sent
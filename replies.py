@@ -0,0 +1,157 @@
+import asyncio
+import contextlib
+import logging
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+from metrics import metrics
+
+COALESCE_WINDOW = 0.1  # Сообщения одному чату за это время (в секундах) уходят одним сообщением
+MAX_ATTEMPTS = 4  # Попыток при сетевых ошибках и RetryAfter
+RETRY_DELAY = 0.5  # Пауза перед первым повтором, дальше удваивается
+MAX_MESSAGE_LENGTH = 4096  # Лимит Telegram на длину сообщения
+SEPARATOR = "\n\n"
+
+
+def merge(batch):
+    """Склеивает сообщения [(текст, клавиатура)] подряд в одно. Клавиатура
+    остаётся у последнего склеенного сообщения, после неё начинается новое."""
+    merged = []
+    for text, reply_markup in batch:
+        if (merged and merged[-1][1] is None
+                and len(merged[-1][0]) + len(SEPARATOR) + len(text) <= MAX_MESSAGE_LENGTH):
+            merged[-1] = (merged[-1][0] + SEPARATOR + text, reply_markup)
+        else:
+            merged.append((text, reply_markup))
+    return merged
+
+
+class Replies:
+    """Исходящие сообщения обработчиков.
+
+    send() не отправляет сообщение сразу: всё, что обработчики прислали
+    одному чату за window секунд, уходит одним sendMessage (см. merge).
+    show() для нажатой inline-кнопки редактирует сообщение с кнопкой
+    вместо отправки нового. Сообщения одного чата уходят в порядке
+    вызовов; сетевые ошибки и RetryAfter повторяются с паузой, а ошибки,
+    после которых повторять бесполезно, пишутся в лог. Если вызывающему
+    нужно знать, дошло ли сообщение, — deliver().
+    """
+
+    def __init__(self, bot, window=COALESCE_WINDOW):
+        self.bot = bot
+        self.window = window
+        self._pending = {}  # chat_id -> [(текст, клавиатура)]
+        self._timers = {}  # chat_id -> задача, которая отправит накопленное
+        self._locks = {}  # chat_id -> [asyncio.Lock, число ожидающих]
+
+    async def send(self, chat_id, text, reply_markup=None):
+        self._pending.setdefault(chat_id, []).append((text, reply_markup))
+        if chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id), name=f"replies-{chat_id}")
+
+    async def deliver(self, chat_id, text, reply_markup=None):
+        """Отправляет сразу, без склейки. Если сообщение не доставлено (например,
+        пользователь заблокировал бота), ошибка поднимается вызывающему."""
+        try:
+            message = await self.call(chat_id, self.bot.send_message, chat_id=chat_id, text=text,
+                                      reply_markup=reply_markup)
+        except TelegramError:
+            metrics.inc("reply_messages_total", result="failed")
+            raise
+        metrics.inc("reply_messages_total", result="sent")
+        return message
+
+    async def show(self, update, text, reply_markup=None):
+        """Экран меню: по нажатию inline-кнопки — правка сообщения с этой кнопкой,
+        иначе (или если сообщение нельзя изменить) — новое сообщение."""
+        query = update.callback_query
+        chat_id = update.effective_user.id
+        if (query is not None and query.message is not None
+                and (reply_markup is None or isinstance(reply_markup, InlineKeyboardMarkup))):
+            try:
+                await self.call(chat_id, query.edit_message_text, text=text, reply_markup=reply_markup)
+                metrics.inc("reply_messages_total", result="edited")
+                return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                logging.warning(f"Failed to edit message in {chat_id}, sending a new one: {e}")
+        await self.send(chat_id, text, reply_markup)
+
+    async def send_document(self, chat_id, **kwargs):
+        await self.call(chat_id, self.bot.send_document, chat_id=chat_id, **kwargs)
+
+    async def call(self, chat, method, **kwargs):
+        """Вызов Bot API после того, как ушли уже накопленные для чата chat сообщения."""
+        async with self._chat_lock(chat):
+            await self._send_pending(chat)
+            return await self._retry(method, **kwargs)
+
+    async def flush(self, chat_id):
+        async with self._chat_lock(chat_id):
+            await self._send_pending(chat_id)
+
+    async def close(self):
+        """Отправляет всё накопленное (при остановке бота)."""
+        for chat_id in list(self._pending):
+            await self.flush(chat_id)
+        await asyncio.gather(*self._timers.values(), return_exceptions=True)
+
+    async def _flush_later(self, chat_id):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            del self._timers[chat_id]
+        try:
+            await self.flush(chat_id)
+        except Exception as e:
+            logging.error(f"Failed to send messages to {chat_id}: {e}", exc_info=True)
+
+    @contextlib.asynccontextmanager
+    async def _chat_lock(self, chat_id):
+        # Блокировка на чат; запись удаляется, когда её никто не ждёт
+        entry = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
+
+    async def _send_pending(self, chat_id):
+        batch = self._pending.pop(chat_id, [])
+        messages = merge(batch)
+        if len(batch) > len(messages):
+            metrics.inc("reply_messages_coalesced_total", len(batch) - len(messages))
+        for text, reply_markup in messages:
+            try:
+                await self._retry(self.bot.send_message, chat_id=chat_id, text=text, reply_markup=reply_markup)
+                metrics.inc("reply_messages_total", result="sent")
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или сообщение неверное: повтор не поможет
+                metrics.inc("reply_messages_total", result="failed")
+                logging.warning(f"Message to {chat_id} not delivered: {e}")
+
+    async def _retry(self, method, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return await method(**kwargs)
+            except BadRequest:
+                raise
+            except RetryAfter as e:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                logging.warning(f"Flood limit hit, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except (TimedOut, NetworkError) as e:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                delay = RETRY_DELAY * 2 ** attempt
+                logging.warning(f"Network error: {e}, retry in {delay}s")
+                metrics.inc("reply_retries_total")
+                await asyncio.sleep(delay)
+
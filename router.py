@@ -0,0 +1,128 @@
+import base64
+import collections
+import hashlib
+import re
+import urllib.parse
+
+MAX_CALLBACK_DATA = 64  # Лимит Telegram на длину callback_data, байт
+SEPARATOR = ":"
+DIGEST_MARK = "#"  # Начало короткого токена вместо длинного значения
+MAX_DIGESTS = 10000  # Сколько токенов помнить; самые давно использованные забываются
+
+# Кто может нажимать кнопку
+GUEST = "guest"  # Только незарегистрированные (выбор класса при регистрации)
+USER = "user"  # Зарегистрированные пользователи
+ADMIN = "admin"  # Админы класса и главный администратор
+
+PLACEHOLDER = re.compile(r"\{(\w+)(?::(int|str))?\}")
+TYPES = {"int": int, "str": str, None: str}
+
+
+class StaleCallback(Exception):
+    """Кнопка ссылается на токен, которого бот не помнит (например, после перезапуска)."""
+
+
+def allowed(access, user):
+    """Может ли пользователь (результат get_user или None) действовать с уровнем доступа access."""
+    if access == GUEST:
+        return user is None
+    if access == ADMIN:
+        return user is not None and user['admin']
+    return user is not None
+
+
+def _escape(value):
+    return re.sub(r"[%:#]", lambda m: f"%{ord(m.group()):02X}", value)
+
+
+def _size(parts):
+    return len(SEPARATOR.join(parts).encode())
+
+
+class Route:
+    """Скомпилированный шаблон вида "hwl:{day}:{lesson}" или "ap:{user_id:int}"."""
+
+    def __init__(self, pattern, handler, access):
+        self.pattern = pattern
+        self.prefix, _, placeholders = pattern.partition(SEPARATOR)
+        self.handler = handler
+        self.access = access
+        matches = list(PLACEHOLDER.finditer(placeholders))
+        if placeholders != SEPARATOR.join(match.group() for match in matches):
+            raise ValueError(f"Bad route pattern: {pattern}")
+        self.params = [(match.group(1), TYPES[match.group(2)]) for match in matches]
+
+    def allows(self, user):
+        return allowed(self.access, user)
+
+
+class CallbackRouter:
+    """Таблица кнопок бота: префикс callback_data -> обработчик.
+
+    Шаблоны разбираются один раз при add(), поиск маршрута — один словарь
+    по префиксу. Параметры приводятся к типу из шаблона; строки
+    экранируются, поэтому могут содержать ':' и '_'. Если callback_data
+    не помещается в 64 байта, самые длинные строковые параметры
+    заменяются коротким токеном, который router запоминает (не больше
+    max_digests последних). Токены живут только в памяти процесса, поэтому
+    маршрутам лучше передавать короткие параметры, например номер вместо
+    названия.
+    """
+
+    def __init__(self, max_digests=MAX_DIGESTS):
+        self._routes = {}
+        self._digests = collections.OrderedDict()
+        self.max_digests = max_digests
+
+    def add(self, pattern, handler, access=USER):
+        route = Route(pattern, handler, access)
+        if route.prefix in self._routes:
+            raise ValueError(f"Duplicate route prefix: {route.prefix}")
+        self._routes[route.prefix] = route
+        return route
+
+    def _digest(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=6).digest()
+        token = DIGEST_MARK + base64.urlsafe_b64encode(digest).decode()
+        self._digests[token] = value
+        self._digests.move_to_end(token)
+        while len(self._digests) > self.max_digests:
+            self._digests.popitem(last=False)
+        return token
+
+    def data(self, prefix, *values):
+        """callback_data для кнопки маршрута prefix с параметрами values."""
+        route = self._routes[prefix]
+        if len(values) != len(route.params):
+            raise TypeError(f"Route {route.pattern} takes {len(route.params)} parameters, got {len(values)}")
+        parts = [prefix] + [_escape(str(value)) for value in values]
+        strings = sorted((i for i, (_, kind) in enumerate(route.params) if kind is str),
+                         key=lambda i: len(parts[i + 1].encode()), reverse=True)
+        for i in strings:
+            if _size(parts) <= MAX_CALLBACK_DATA:
+                break
+            parts[i + 1] = self._digest(str(values[i]))
+        if _size(parts) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback_data for {route.pattern} is longer than {MAX_CALLBACK_DATA} bytes")
+        return SEPARATOR.join(parts)
+
+    def resolve(self, data):
+        """(маршрут, параметры) или (None, {}), если такой кнопки нет."""
+        prefix, *raw_values = data.split(SEPARATOR)
+        route = self._routes.get(prefix)
+        if route is None or len(raw_values) != len(route.params):
+            return None, {}
+        params = {}
+        for (name, kind), raw in zip(route.params, raw_values):
+            if raw.startswith(DIGEST_MARK):
+                value = self._digests.get(raw)
+                if value is None:
+                    raise StaleCallback(data)
+                self._digests.move_to_end(raw)
+            else:
+                value = urllib.parse.unquote(raw)
+            try:
+                params[name] = kind(value)
+            except ValueError:
+                return None, {}
+        return route, params
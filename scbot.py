@@ -1,14 +1,29 @@
+import asyncio
 import logging
 import datetime
-import json
+import importlib.util
+import os
+import sys
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from broadcast import Broadcaster
+from cluster import Lease, run_cluster, run_worker
+from conversation import Conversations, State
+from metrics import InstrumentedRequest, MetricsServer, sampled_log, timed
+from reminders import WEEKDAYS, ReminderScheduler
+from replies import Replies
+from router import ADMIN, GUEST, USER, CallbackRouter, StaleCallback, allowed
+from search import parse_query, tokenize
+from storage import AsyncStorage, open_storage, migrate_json_to_sqlite, valid_class_name
+from transfer import MAX_ERRORS, ImportFormatError, export_csv, export_json, parse_week_file
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.error import Forbidden, TelegramError
 from telegram.ext import (
-    Updater,
+    Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
-    Filters,
+    filters,
     CallbackContext,
 )
 
@@ -16,453 +31,1250 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
 
-ADMIN_ID = 123  # Замените на ID администратора
+ADMIN_ID = 123  # Замените на ID главного администратора (управляет классами, админ в любом классе)
 print(f"Admin ID: {ADMIN_ID}") # Вывод ID админа
 TOKEN = ""  # Замените на токен вашего бота
 
-DATABASE_FILE = "data.json"
+DATABASE_FILE = "data.json"  # Общий реестр: классы, пользователи, админы, рассылки
+SQLITE_FILE = "data.db"
+CLASSES_DIR = "classes"  # Данные каждого класса — в своём файле в этом каталоге
+DEFAULT_CLASS = "основной"  # Создаётся при первом запуске, сюда переносится база без классов
 
 
-def load_data():
-    try:
-        with open(DATABASE_FILE, "r") as f:
-            data = json.load(f)
-            if "pending_users" in data:
-                data["pending_users"] = {int(k): v for k, v in data["pending_users"].items()}
-            if "users" in data:
-                data["users"] = [int(user) for user in data["users"]]
-            return data
+STORAGE_BACKEND = "json"  # "json" (data.json) или "sqlite" (data.db)
+CONCURRENT_UPDATES = 256  # Сколько обновлений обрабатывается одновременно
+CONNECTION_POOL_SIZE = 256  # Одновременных HTTP-запросов к Bot API
+
+PAGE_SIZE = 10  # Сколько заявок или сообщений обратной связи показывать на одной странице
+PREVIEW_LENGTH = 300  # До скольких символов обрезаются длинные тексты в списках (обратная связь, поиск)
+MAX_IMPORT_SIZE = 1024 * 1024  # Максимальный размер файла с расписанием и ДЗ, байт
+REMINDER_TIMES = ["18:00", "19:00", "20:00", "21:00"]  # Время напоминания на кнопках (любое — через /reminder)
+SEARCH_LIMIT = 15  # Сколько последних результатов /search показывать
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9090  # Эндпоинт /metrics для Prometheus, 0 — выключен
+METRICS_LOG_INTERVAL = 300  # Как часто (в секундах) писать сводку метрик в лог, 0 — не писать
+
+# Режим webhook. Если WEBHOOK_URL пустой, бот работает через long polling.
+WEBHOOK_URL = ""  # Публичный адрес бота за reverse proxy, например "https://bot.example.com"
+WEBHOOK_LISTEN = "127.0.0.1"  # Адрес, на котором слушает встроенный HTTP-сервер
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"  # Путь, на который Telegram присылает обновления
+WEBHOOK_SECRET = ""  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_CERT = None  # Путь к публичному сертификату (для самоподписанного TLS без proxy)
+WEBHOOK_KEY = None  # Путь к закрытому ключу сертификата
 
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {
-            "users": [],
-            "pending_users": {},
-            "schedule": {},
-            "homework": {},
-            "feedback": [],
-            "announcements": [],
-        }
+# Несколько процессов бота: python scbot.py workers [N] (только с STORAGE_BACKEND = "sqlite")
+WORKERS = 4  # Число рабочих процессов по умолчанию (обычно — число ядер)
+WORKER_HOST = "127.0.0.1"
+WORKER_BASE_PORT = 8500  # Рабочий процесс i слушает порт WORKER_BASE_PORT + i
+BROADCAST_POLL_INTERVAL = 5.0  # Как часто процесс с рассылками проверяет очередь, поставленную другими
+WORKER_ID = None  # Номер рабочего процесса; None — бот работает одним процессом
 
 
-def save_data(data):
-    data_to_save = data.copy()
+storage = AsyncStorage(open_storage(STORAGE_BACKEND, DATABASE_FILE, SQLITE_FILE, CLASSES_DIR, DEFAULT_CLASS))
+router = CallbackRouter()  # Таблица кнопок заполняется после определения обработчиков
 
-    if "pending_users" in data_to_save:
-        data_to_save["pending_users"] = {str(k): v for k, v in data_to_save["pending_users"].items()}
 
-    with open(DATABASE_FILE, "w") as f:
-        json.dump(data_to_save, f, indent=4)
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных пользователей параллельно, а обновления
+    одного пользователя — строго по очереди, чтобы шаги диалога
+    (см. Conversations) не перемешивались.
+
+    Очередь пользователя ждёт до семафора max_concurrent_updates: иначе
+    обновления одного быстрого пользователя, ожидая друг друга, заняли бы
+    все места и остальные пользователи стояли бы. Поэтому process_update
+    переопределён, хотя в PTB помечен как final."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # user_id -> [asyncio.Lock, число ожидающих обновлений]
+
+    async def process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
 
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user.id]
 
-def initialize_admin():
-    data = load_data()
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+async def initialize_admin():
     admin_id = 123  # Замените на ID администратора
-    if admin_id not in data["users"]:
-        data["users"].append(admin_id)
-        save_data(data)
+    classes = await storage.list_classes()
+    if not classes:
+        await storage.add_class(DEFAULT_CLASS)
+        classes = [DEFAULT_CLASS]
+    if not await storage.is_user(admin_id):
+        await storage.add_user(classes[0], admin_id)
         print("Admin user initialized")
-    return data
 
 
-def start(update: Update, context: CallbackContext):
+async def get_user(user_id):
+    """Класс пользователя и права: {'class': ..., 'admin': ...} или None.
+    ADMIN_ID — админ того класса, в котором он сейчас находится."""
+    user = await storage.get_user(user_id)
+    if user is not None and user_id == ADMIN_ID:
+        user['admin'] = True
+    return user
+
+
+async def manages_class(user_id, user, class_id):
+    """Может ли админ работать с классом class_id: ADMIN_ID — с любым, админ класса — со своим."""
+    if user is None or not user['admin']:
+        return False
+    if user_id == ADMIN_ID:
+        return await storage.has_class(class_id)
+    return user['class'] == class_id
+
+
+async def ask_registration_name(context: CallbackContext, user_id, class_id, text):
+    await context.bot_data['conversations'].set(user_id, State.REGISTRATION, class_id)
+    await context.bot_data['replies'].send(chat_id=user_id, text=text)
+
+
+@timed
+async def start(update: Update, context: CallbackContext):
     try:
         user_id = update.effective_user.id
-        print(f"User ID (start): {user_id}")
-        data = load_data()
-        if user_id in data["users"]:
+        sampled_log("start", user_id=user_id)
+        if await storage.is_user(user_id):
             keyboard = [
                 ["Расписание"],
                 ["Домашнее задание"],
                 ["Обратная связь"],
+                ["Напоминания"],
             ]
             reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            context.bot.send_message(
+            await context.bot_data['replies'].send(
                 chat_id=user_id, text="Выберите действие:", reply_markup=reply_markup
             )
-        elif user_id in data["pending_users"]:
-            context.bot.send_message(chat_id=user_id, text="Ваша заявка на регистрацию ожидает рассмотрения.")
+        elif await storage.get_pending_class(user_id) is not None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Ваша заявка на регистрацию ожидает рассмотрения.")
         else:
-            context.bot.send_message(
-                chat_id=user_id,
-                text="Привет! Для регистрации, пожалуйста, введите ваше имя и фамилию в формате 'Имя Фамилия':"
-            )
-            context.user_data['registration_mode'] = True
+            classes = await storage.list_classes()
+            if len(classes) == 1:
+                await ask_registration_name(
+                    context, user_id, classes[0],
+                    "Привет! Для регистрации, пожалуйста, введите ваше имя и фамилию в формате 'Имя Фамилия':")
+                return
+            buttons = [InlineKeyboardButton(class_id, callback_data=router.data("reg", class_id))
+                       for class_id in classes]
+            keyboard = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+            await context.bot_data['replies'].send(chat_id=user_id, text="Привет! Для регистрации выберите ваш класс:",
+                                                   reply_markup=InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logging.error(f"Error in start: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def button(update: Update, context: CallbackContext):
+@timed
+async def button(update: Update, context: CallbackContext):
     try:
         query = update.callback_query
         if query:
-            query.answer()
+            await query.answer()
             action = query.data
         else:
             action = update.message.text
         user_id = update.effective_user.id
-        print(f"User ID (button): {user_id}")
-        if action == "Расписание":
-            show_schedule(update, context)
-        elif action == "Домашнее задание":
-            show_homework_menu(update, context)
-        elif action == "Обратная связь":
-            send_feedback(update, context)
-        elif action == "approve_user":
-            if user_id == ADMIN_ID:
-                show_pending_users(update, context)
-        elif action.startswith("approve_"):
-            if user_id == ADMIN_ID:
-                user_to_approve = int(action.split("_")[1])
-                approve_user(update, context, user_to_approve)
-        elif action == "add_schedule":
-            if user_id == ADMIN_ID:
-                context.bot.send_message(chat_id=user_id,
-                                         text="Введите день недели и расписание в формате 'понедельник:урок1,урок2,...' :")
-                context.user_data['add_schedule_data'] = True
-                return
-        elif action == "add_homework":
-            if user_id == ADMIN_ID:
-                context.bot.send_message(
-                    chat_id=user_id,
-                    text="Введите ДЗ в формате 'день_недели:урок:дз'. Например, 'понедельник:математика:стр. 12 упр. 5'",
-                )
-                context.user_data['add_homework_data'] = True
-                return
-        elif action == "send_announcement":
-            if user_id == ADMIN_ID:
-                context.bot.send_message(chat_id=user_id, text="Введите объявление для всех пользователей:")
-                context.user_data['announcement_text'] = True
+        sampled_log("button", user_id=user_id, action=action)
+        try:
+            route, params = router.resolve(action)
+        except StaleCallback:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Кнопка устарела, откройте меню заново.")
+            return
+        if route is None:
+            return
+        user = await get_user(user_id)
+        if not route.allows(user):
+            return
+        class_id = user['class'] if user is not None else None
+        if "class_id" in params:
+            # Кнопка действует в классе, где её показали, а не в текущем классе админа
+            class_id = params.pop("class_id")
+            if not await manages_class(user_id, user, class_id):
+                await context.bot_data['replies'].send(chat_id=user_id, text="У вас нет прав администратора.")
                 return
-        elif action == 'view_feedback':
-            if user_id == ADMIN_ID:
-                show_admin_feedback(update, context)
-        elif action.startswith("reply_feedback_"):
-            if user_id == ADMIN_ID:
-                feedback_id = int(action.split("_")[2])
-                context.user_data['replying_to'] = feedback_id
-                context.bot.send_message(chat_id=user_id, text="Введите ответ:")
-                return 'replying_feedback_text'
-
-        elif action == 'admin_menu':
-            if user_id == ADMIN_ID:
-                show_admin_menu(update, context)
-        elif action.startswith("homework_"):
-            parts = action.split("_")
-            if len(parts) == 2:
-                day = parts[1]
-                show_homework_by_day(update, context, day)
-            elif len(parts) == 3:
-                day, lesson = parts[1], parts[2]
-                show_homework_by_lesson(update, context, day, lesson)
+        await route.handler(update, context, class_id, **params)
     except Exception as e:
         logging.error(f"Error in button handler: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+async def choose_class(update: Update, context: CallbackContext, class_id, name):
+    if await storage.has_class(name):
+        await ask_registration_name(context, update.effective_user.id, name,
+                                    f"Класс {name}. Введите ваше имя и фамилию в формате 'Имя Фамилия':")
+
+
+async def ask_schedule(update: Update, context: CallbackContext, class_id):
+    await context.bot_data['replies'].send(chat_id=update.effective_user.id,
+                                           text="Введите день недели и расписание в формате 'понедельник:урок1,урок2,...' :")
+    await context.bot_data['conversations'].set(update.effective_user.id, State.SCHEDULE)
+
+
+async def ask_homework(update: Update, context: CallbackContext, class_id):
+    await context.bot_data['replies'].send(
+        chat_id=update.effective_user.id,
+        text="Введите ДЗ в формате 'день_недели:урок:дз'. Например, 'понедельник:математика:стр. 12 упр. 5'",
+    )
+    await context.bot_data['conversations'].set(update.effective_user.id, State.HOMEWORK)
+
+
+async def ask_announcement(update: Update, context: CallbackContext, class_id):
+    await context.bot_data['replies'].send(chat_id=update.effective_user.id,
+                                           text=f"Введите объявление для всех пользователей класса {class_id}:")
+    await context.bot_data['conversations'].set(update.effective_user.id, State.ANNOUNCEMENT)
+
+
+async def ask_feedback_reply(update: Update, context: CallbackContext, class_id, feedback_id):
+    await context.bot_data['conversations'].set(update.effective_user.id, State.FEEDBACK_REPLY,
+                                                f"{class_id}:{feedback_id}")
+    await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Введите ответ:")
+
+
+async def ask_import(update: Update, context: CallbackContext, class_id):
+    await context.bot_data['conversations'].set(update.effective_user.id, State.IMPORT)
+    await context.bot_data['replies'].send(
+        chat_id=update.effective_user.id,
+        text=f"Пришлите файл CSV или JSON с расписанием и ДЗ класса {class_id}.\n"
+             "CSV: первая строка 'раздел,день,урок,дз', далее строки вида\n"
+             "расписание,понедельник,математика,\n"
+             "дз,понедельник,математика,стр. 12 упр. 5\n"
+             "Расписание указанных в файле дней заменяется целиком, ДЗ добавляется. "
+             "Пример файла можно получить командой /export.",
+    )
+
+
+async def cancel_import(update: Update, context: CallbackContext, class_id, arg):
+    await context.bot_data['conversations'].finish(update.effective_user.id)
+    await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Загрузка из файла отменена")
+
+
+async def import_week_file(update: Update, context: CallbackContext, class_id):
+    user_id = update.effective_user.id
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_IMPORT_SIZE:
+        await context.bot_data['replies'].send(chat_id=user_id, text="Файл слишком большой")
+        return
+    file = await context.bot.get_file(document.file_id)
+    content = bytes(await file.download_as_bytearray())
+    try:
+        schedule, homework = parse_week_file(document.file_name or "", content)
+    except ImportFormatError as e:
+        errors = "\n".join(e.errors[:MAX_ERRORS])
+        more = f"\n... и ещё {len(e.errors) - MAX_ERRORS}" if len(e.errors) > MAX_ERRORS else ""
+        await context.bot_data['replies'].send(chat_id=user_id,
+                                               text=f"Файл не загружен, исправьте ошибки и пришлите его снова:\n{errors}{more}")
+        return
+
+    await storage.import_week(class_id, schedule, homework)
+    invalidate_schedule_views(class_id)
+    for day, tasks in homework.items():
+        for lesson in tasks:
+            invalidate_homework_views(class_id, day, lesson)
+    await context.bot_data['conversations'].finish(user_id)
+    tasks = sum(len(tasks) for tasks in homework.values())
+    await context.bot_data['replies'].send(chat_id=user_id,
+                                           text=f"Загружено: расписание на {len(schedule)} дн., заданий ДЗ: {tasks}")
+
+
+@timed
+async def export_week(update: Update, context: CallbackContext, class_id, fmt="csv"):
+    try:
+        schedule = await storage.get_schedule(class_id)
+        homework = await storage.get_homework(class_id)
+        export = export_json if fmt == "json" else export_csv
+        await context.bot_data['replies'].send_document(update.effective_user.id, document=export(schedule, homework),
+                                                        filename=f"{class_id}.{'json' if fmt == 'json' else 'csv'}",
+                                                        caption=f"Расписание и ДЗ класса {class_id}")
+    except Exception as e:
+        logging.error(f"Error in export_week: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+async def save_registration(update: Update, context: CallbackContext, class_id, registration_class):
+    user_id = update.effective_user.id
+    try:
+        name, surname = update.message.text.split(" ", 1)
+    except ValueError:
+        await context.bot_data['replies'].send(chat_id=user_id,
+                                               text="Неверный формат. Введите ваше имя и фамилию в формате 'Имя Фамилия'")
+        return
+    await storage.add_pending(registration_class, user_id, name, surname)
+    await context.bot_data['replies'].send(chat_id=user_id, text="Ваша заявка на регистрацию отправлена администратору.")
+    await context.bot_data['conversations'].finish(user_id)
+
+
+async def save_feedback(update: Update, context: CallbackContext, class_id, arg):
+    user_id = update.effective_user.id
+    await storage.add_feedback(class_id, user_id, update.message.text)
+    await context.bot_data['replies'].send(chat_id=user_id, text="Сообщение отправлено администратору")
+    await context.bot_data['conversations'].finish(user_id)
+
+
+async def save_schedule(update: Update, context: CallbackContext, class_id, arg):
+    user_id = update.effective_user.id
+    try:
+        day, schedule_str = update.message.text.split(":", 1)
+        lessons = schedule_str.split(",")
+        await storage.set_schedule_day(class_id, day.lower(), lessons)
+        invalidate_schedule_views(class_id)
+        await context.bot_data['replies'].send(chat_id=user_id, text="Расписание обновлено")
+    except ValueError:
+        await context.bot_data['replies'].send(chat_id=user_id, text="Неверный формат")
+    finally:
+        await context.bot_data['conversations'].finish(user_id)
+
+
+async def save_homework(update: Update, context: CallbackContext, class_id, arg):
+    user_id = update.effective_user.id
+    try:
+        day, lesson, homework = update.message.text.split(":", 2)
+        await storage.set_homework(class_id, day.lower(), lesson.lower(), homework)
+        invalidate_homework_views(class_id, day.lower(), lesson.lower())
+        await context.bot_data['replies'].send(chat_id=user_id, text="Домашнее задание добавлено")
+    except ValueError:
+        await context.bot_data['replies'].send(chat_id=user_id, text="Неверный формат")
+    finally:
+        await context.bot_data['conversations'].finish(user_id)
+
+
+async def send_announcement(update: Update, context: CallbackContext, class_id, arg):
+    user_id = update.effective_user.id
+    text = update.message.text
+    await storage.add_announcement(class_id, text)
+    broadcast_id = await context.bot_data['broadcaster'].submit(text, admin_id=user_id, class_id=class_id)
+    await context.bot_data['replies'].send(chat_id=user_id, text=f"Объявление поставлено в очередь рассылки (#{broadcast_id})")
+    await context.bot_data['conversations'].finish(user_id)
 
 
-def handle_message(update: Update, context: CallbackContext):
+async def send_feedback_reply(update: Update, context: CallbackContext, class_id, arg):
+    user_id = update.effective_user.id
+    # Номера сообщений в каждом классе свои: отвечаем в классе, где нажали «Ответить»
+    class_id, _, feedback_id = arg.rpartition(":")
+    feedback_id = int(feedback_id)
+    # Диалог завершается при любом исходе, иначе следующее сообщение админа снова ушло бы как ответ
+    try:
+        if not await manages_class(user_id, await get_user(user_id), class_id):
+            await context.bot_data['replies'].send(chat_id=user_id, text="У вас нет прав администратора.")
+            return
+        feedback_item = await storage.get_feedback(class_id, feedback_id)
+        if not feedback_item:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Сообщение не найдено")
+            return
+        user_to_reply = feedback_item['user_id']
+        try:
+            # Отвеченным сообщение считается, только если ответ дошёл
+            await context.bot_data['replies'].deliver(user_to_reply, f"Ответ от администратора:\n{update.message.text}")
+        except Forbidden:
+            await context.bot_data['replies'].send(chat_id=user_id,
+                                                   text="Ответ не доставлен: пользователь заблокировал бота")
+        except TelegramError as e:
+            logging.warning(f"Feedback reply to {user_to_reply} not delivered: {e}")
+            await context.bot_data['replies'].send(
+                chat_id=user_id, text="Ответ не доставлен из-за ошибки Telegram. Попробуйте ответить позже")
+        else:
+            await storage.mark_feedback_answered(class_id, feedback_id, feedback_id)
+            await context.bot_data['replies'].send(chat_id=user_id, text="Ответ отправлен")
+    finally:
+        await context.bot_data['conversations'].finish(user_id)
+
+
+# Шаг диалога -> обработчик следующего сообщения пользователя и кто может его отправить
+conversation_steps = {
+    State.REGISTRATION: (save_registration, GUEST),
+    State.FEEDBACK: (save_feedback, USER),
+    State.SCHEDULE: (save_schedule, ADMIN),
+    State.HOMEWORK: (save_homework, ADMIN),
+    State.ANNOUNCEMENT: (send_announcement, ADMIN),
+    State.FEEDBACK_REPLY: (send_feedback_reply, ADMIN),
+    State.IMPORT: (cancel_import, ADMIN),
+}
+
+
+@timed
+async def handle_message(update: Update, context: CallbackContext):
     try:
         user_id = update.effective_user.id
         text = update.message.text
-        data = load_data()
-        if context.user_data.get('registration_mode'):
-            try:
-                name, surname = text.split(" ", 1)
-                data["pending_users"][int(user_id)] = {  # Сохраняем ID как int
-                    'name': name,
-                    'surname': surname,
-                }
-                save_data(data)
-                context.bot.send_message(chat_id=user_id, text="Ваша заявка на регистрацию отправлена администратору.")
-                context.user_data.pop('registration_mode', None)
-            except ValueError:
-                context.bot.send_message(chat_id=user_id,
-                                         text="Неверный формат. Введите ваше имя и фамилию в формате 'Имя Фамилия'")
-
-        elif context.user_data.get('add_schedule_data'):
-            if user_id == ADMIN_ID:
-                try:
-                    day, schedule_str = text.split(":", 1)
-                    lessons = schedule_str.split(",")
-                    data["schedule"][day.lower()] = lessons
-                    save_data(data)
-                    context.bot.send_message(chat_id=user_id, text="Расписание обновлено")
-                except ValueError:
-                    context.bot.send_message(chat_id=user_id, text="Неверный формат")
-                finally:
-                    context.user_data.pop('add_schedule_data', None)
-        elif context.user_data.get('add_homework_data'):
-            if user_id == ADMIN_ID:
-                try:
-                    day, lesson, homework = text.split(":", 2)
-                    data["homework"].setdefault(day.lower(), {})[lesson.lower()] = homework
-                    save_data(data)
-                    context.bot.send_message(chat_id=user_id, text="Домашнее задание добавлено")
-                except ValueError:
-                    context.bot.send_message(chat_id=user_id, text="Неверный формат")
-                finally:
-                    context.user_data.pop('add_homework_data', None)
-        elif context.user_data.get('announcement_text'):
-            if user_id == ADMIN_ID:
-                data["announcements"].append(text)
-                save_data(data)
-                for user in data["users"]:
-                    context.bot.send_message(chat_id=user, text=f"Новое объявление от администратора:\n{text}")
-                context.bot.send_message(chat_id=user_id, text="Объявление отправлено")
-                context.user_data.pop('announcement_text', None)
-
-        elif context.user_data.get('replying_to'):
-            if user_id == ADMIN_ID:
-                feedback_id = context.user_data.get('replying_to')
-                feedback_item = next((item for item in data['feedback'] if item['id'] == feedback_id), None)
-                if feedback_item:
-                    user_to_reply = feedback_item['user_id']
-                    context.bot.send_message(chat_id=user_to_reply, text=f"Ответ от администратора:\n{text}")
-                    context.bot.send_message(chat_id=user_id, text="Ответ отправлен")
-                else:
-                    context.bot.send_message(chat_id=user_id, text="Сообщение не найдено")
-                context.user_data.pop('replying_to', None)
-
-        elif user_id in data["users"] and context.user_data.get('feedback_mode'):
-            new_feedback = {
-                'id': len(data['feedback']) + 1,
-                'user_id': user_id,
-                'text': text,
-            }
-            data["feedback"].append(new_feedback)
-            save_data(data)
-            context.bot.send_message(chat_id=user_id, text="Сообщение отправлено администратору")
-            context.user_data.pop('feedback_mode', None)
-
-
-        elif user_id in data["users"] and (
-                text == "Расписание" or text == "Домашнее задание" or text == "Обратная связь"):
-            button(update, context)
+        user = await get_user(user_id)
+        conversations = context.bot_data['conversations']
+        state, arg = await conversations.get(user_id)
+        if state is not None:
+            handler, access = conversation_steps[state]
+            if allowed(access, user):
+                await handler(update, context, user['class'] if user is not None else None, arg)
+            else:
+                await conversations.finish(user_id)
+        elif text in ("Расписание", "Домашнее задание", "Обратная связь", "Напоминания") and user is not None:
+            await button(update, context)
     except Exception as e:
         logging.error(f"Error in message handler: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+@timed
+async def handle_document(update: Update, context: CallbackContext):
+    try:
+        user_id = update.effective_user.id
+        user = await get_user(user_id)
+        state, arg = await context.bot_data['conversations'].get(user_id)
+        if state is State.IMPORT and allowed(ADMIN, user):
+            await import_week_file(update, context, user['class'])
+    except Exception as e:
+        logging.error(f"Error in document handler: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+@timed
+async def transfer_command(update: Update, context: CallbackContext):
+    # /import — загрузить расписание и ДЗ файлом, /export [csv|json] — выгрузить
+    try:
+        user_id = update.effective_user.id
+        user = await get_user(user_id)
+        if not allowed(ADMIN, user):
+            await context.bot_data['replies'].send(chat_id=user_id, text="У вас нет прав администратора.")
+        elif update.message.text.startswith("/import"):
+            await ask_import(update, context, user['class'])
+        else:
+            fmt = context.args[0].lower() if context.args else "csv"
+            await export_week(update, context, user['class'], fmt)
+    except Exception as e:
+        logging.error(f"Error in transfer_command: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def admin_command(update: Update, context: CallbackContext):
+@timed
+async def admin_command(update: Update, context: CallbackContext):
     try:
         user_id = update.effective_user.id
-        if user_id == ADMIN_ID:
-            show_admin_menu(update, context)
+        user = await get_user(user_id)
+        if user is not None and user['admin']:
+            await show_admin_menu(update, context, user['class'])
         else:
-            context.bot.send_message(chat_id=user_id, text="У вас нет прав администратора.")
+            await context.bot_data['replies'].send(chat_id=user_id, text="У вас нет прав администратора.")
     except Exception as e:
         logging.error(f"Error in admin_command: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def approve_user(update: Update, context: CallbackContext, user_id):
+CLASSES_HELP = (
+    "Команды:\n"
+    "/classes add <класс> — создать класс\n"
+    "/classes use <класс> — перейти в класс\n"
+    "/classes admin <ID> — сделать пользователя админом его класса\n"
+    "/classes unadmin <ID> — снять права админа"
+)
+
+
+@timed
+async def classes_command(update: Update, context: CallbackContext):
+    """Управление классами, доступно только главному администратору."""
     try:
-        data = load_data()
-        if update.effective_user.id == ADMIN_ID:
-            if int(user_id) in data["pending_users"]:
-                data["users"].append(int(user_id))
-                name = data["pending_users"][int(user_id)]['name']
-                surname = data["pending_users"][int(user_id)]['surname']
-                del data["pending_users"][int(user_id)]
-                save_data(data)
-                context.bot.send_message(chat_id=ADMIN_ID, text=f"Пользователь {name} {surname} одобрен.")
-                context.bot.send_message(chat_id=int(user_id),
-                                         text="Ваша заявка на регистрацию одобрена! Теперь вам доступны все функции бота.")
+        user_id = update.effective_user.id
+        if user_id != ADMIN_ID:
+            await context.bot_data['replies'].send(chat_id=user_id, text="У вас нет прав администратора.")
+            return
+
+        args = context.args or []
+        if not args:
+            user = await storage.get_user(user_id)
+            message = f"Классы (вы сейчас в классе {user['class'] if user else '—'}):\n"
+            for class_id in await storage.list_classes():
+                message += f"- {class_id}: пользователей {len(await storage.list_users(class_id))}\n"
+            await context.bot_data['replies'].send(chat_id=user_id, text=f"{message}\n{CLASSES_HELP}")
+        elif args[0] == "add" and len(args) == 2:
+            if not valid_class_name(args[1]):
+                await context.bot_data['replies'].send(
+                    chat_id=user_id, text="Название класса: буквы, цифры, '-' и '_', не длиннее 16 символов")
+            elif await storage.add_class(args[1]):
+                await context.bot_data['replies'].send(chat_id=user_id, text=f"Класс {args[1]} создан")
+            else:
+                await context.bot_data['replies'].send(chat_id=user_id, text=f"Класс {args[1]} уже есть")
+        elif args[0] == "use" and len(args) == 2:
+            if await storage.has_class(args[1]):
+                await storage.add_user(args[1], user_id)
+                await context.bot_data['replies'].send(chat_id=user_id, text=f"Теперь вы в классе {args[1]}")
+            else:
+                await context.bot_data['replies'].send(chat_id=user_id, text="Класс не найден")
+        elif args[0] in ("admin", "unadmin") and len(args) == 2 and args[1].isdigit():
+            target = await storage.get_user(int(args[1]))
+            if target is None:
+                await context.bot_data['replies'].send(chat_id=user_id, text="Пользователь не найден")
             else:
-                context.bot.send_message(chat_id=ADMIN_ID, text="Пользователь не найден в списке ожидания.")
+                await storage.set_admin(int(args[1]), args[0] == "admin")
+                status = "админ" if args[0] == "admin" else "больше не админ"
+                await context.bot_data['replies'].send(chat_id=user_id,
+                                                       text=f"Пользователь {args[1]} теперь {status} класса {target['class']}")
+        else:
+            await context.bot_data['replies'].send(chat_id=user_id, text=CLASSES_HELP)
+    except Exception as e:
+        logging.error(f"Error in classes_command: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+async def notify_approved(context, user_id):
+    """Сообщает пользователю, что заявка одобрена; False, если сообщение не дошло."""
+    try:
+        await context.bot_data['replies'].deliver(
+            user_id, "Ваша заявка на регистрацию одобрена! Теперь вам доступны все функции бота.")
+        return True
+    except TelegramError as e:
+        logging.warning(f"Approval notice to {user_id} not delivered: {e}")
+        return False
+
+
+@timed
+async def approve_user(update: Update, context: CallbackContext, class_id, user_id):
+    try:
+        pending = await storage.approve_pending(class_id, user_id)
+        if pending is not None:
+            name = pending['name']
+            surname = pending['surname']
+            await context.bot_data['replies'].send(chat_id=update.effective_user.id, text=f"Пользователь {name} {surname} одобрен.")
+            if not await notify_approved(context, int(user_id)):
+                await context.bot_data['replies'].send(chat_id=update.effective_user.id,
+                                                       text="Не удалось отправить пользователю уведомление об одобрении.")
+        else:
+            await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Пользователь не найден в списке ожидания.")
     except Exception as e:
         logging.error(f"Error in approve_user: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id,
-                                 text="Произошла ошибка при одобрении. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id,
+                                               text="Произошла ошибка при одобрении. Попробуйте позже")
+
+
+def preview(text):
+    """Текст для списка: не длиннее PREVIEW_LENGTH символов."""
+    if len(text) > PREVIEW_LENGTH:
+        return text[:PREVIEW_LENGTH] + "…"
+    return text
+
+
+def page_count(total):
+    return max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
+
+
+def page_navigation(prefix, page, pages):
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("« Назад", callback_data=router.data(prefix, page - 1)))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton("Вперёд »", callback_data=router.data(prefix, page + 1)))
+    return row
 
 
-def show_pending_users(update: Update, context: CallbackContext):
+@timed
+async def show_pending_users(update: Update, context: CallbackContext, class_id, page=0):
     try:
-        user_id = update.effective_user.id
-        if user_id == ADMIN_ID:
-            data = load_data()
-            if not data["pending_users"]:
-                context.bot.send_message(chat_id=user_id, text="Нет новых заявок на регистрацию.")
-                return
+        total = await storage.count_pending(class_id)
+        if not total:
+            await context.bot_data['replies'].show(update, "Нет новых заявок на регистрацию.",
+                            InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=router.data("adm"))]]))
+            return
+
+        pages = page_count(total)
+        page = min(page, pages - 1)
+        pending_users = await storage.list_pending(class_id, page * PAGE_SIZE, PAGE_SIZE)
 
-            for user, user_data in data["pending_users"].items():  # user теперь int
-                logging.info(f"Pending user ID: {user}, name: {user_data['name']}, surname: {user_data['surname']}")
-                keyboard = [
-                    [InlineKeyboardButton("Одобрить", callback_data=f"approve_{user}")]]  # callback_data c int user
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"ID: {user}, Имя: {user_data['name']}, Фамилия: {user_data['surname']}",
-                    reply_markup=reply_markup
-                )
-                logging.info(f"Button callback_data: approve_{user}")
-
-            keyboard = [[InlineKeyboardButton("Назад", callback_data="admin_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            context.bot.send_message(chat_id=user_id, text="Выберите пользователя для одобрения.",
-                                     reply_markup=reply_markup)
+        message = f"Заявки на регистрацию (страница {page + 1} из {pages}, всего {total}):\n"
+        keyboard = []
+        for user, user_data in pending_users.items():
+            message += f"\nID: {user}, Имя: {user_data['name']}, Фамилия: {user_data['surname']}"
+            keyboard.append([InlineKeyboardButton(f"Одобрить {user_data['name']} {user_data['surname']}",
+                                                  callback_data=router.data("ap", class_id, user))])
+        # В кнопке — ID показанных заявок: пока админ смотрит страницу, список может сдвинуться
+        shown = ",".join(str(user) for user in pending_users)
+        keyboard.append([InlineKeyboardButton("Одобрить всех на странице", callback_data=router.data("apg", class_id, shown, page))])
+        navigation = page_navigation("pend", page, pages)
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("В админ панель", callback_data=router.data("adm"))])
+        await context.bot_data['replies'].show(update, message, InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logging.error(f"Error in show_pending_users: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id,
-                                 text="Произошла ошибка при выводе ожидающих пользователей. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id,
+                                               text="Произошла ошибка при выводе ожидающих пользователей. Попробуйте позже")
 
 
-def show_schedule(update: Update, context: CallbackContext):
+@timed
+async def approve_page(update: Update, context: CallbackContext, class_id, user_ids, page):
+    try:
+        approved = undelivered = 0
+        for user in map(int, user_ids.split(",")):
+            if await storage.approve_pending(class_id, user) is not None:
+                approved += 1
+                if not await notify_approved(context, user):
+                    undelivered += 1
+        message = f"Одобрено пользователей: {approved}"
+        if undelivered:
+            message += f" (не удалось отправить уведомление: {undelivered})"
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text=message)
+        await show_pending_users(update, context, class_id, page)
+    except Exception as e:
+        logging.error(f"Error in approve_page: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id,
+                                               text="Произошла ошибка при одобрении. Попробуйте позже")
+
+
+class RenderCache:
+    """Готовые тексты и клавиатуры экранов расписания и ДЗ.
+
+    Экран собирается при первом запросе и хранится, пока админ не изменит
+    данные, из которых он построен (см. invalidate_schedule_views и
+    invalidate_homework_views).
+
+    Если данные класса могут менять другие процессы бота, задайте versions —
+    async-функцию class_id -> версия данных класса: при смене версии
+    экраны класса собираются заново.
+    """
+
+    def __init__(self, versions=None):
+        self.versions = versions
+        self._class_versions = {}
+        self._views = {}
+        self._generation = 0
+
+    async def _check_version(self, class_id):
+        version = await self.versions(class_id)
+        if self._class_versions.setdefault(class_id, version) != version:
+            self._class_versions[class_id] = version
+            self.invalidate(*[key for key in self._views if key[1] == class_id])
+
+    async def get(self, key, render):
+        # Ключ экрана — (вид, класс, ...)
+        if self.versions is not None:
+            await self._check_version(key[1])
+        view = self._views.get(key)
+        if view is None:
+            generation = self._generation
+            view = await render()
+            # Если данные поменялись, пока экран собирался, не кэшируем его
+            if view is not None and generation == self._generation:
+                self._views[key] = view
+        return view
+
+    def invalidate(self, *keys):
+        self._generation += 1
+        for key in keys:
+            self._views.pop(key, None)
+
+    def invalidate_prefix(self, *prefix):
+        """Сбрасывает все экраны, ключ которых начинается с prefix."""
+        self.invalidate(*[key for key in self._views if key[:len(prefix)] == prefix])
+
+
+render_cache = RenderCache()
+
+
+def invalidate_schedule_views(class_id):
+    render_cache.invalidate(("schedule", class_id), *(("reminder", class_id, day) for day in WEEKDAYS))
+
+
+def invalidate_homework_views(class_id, day, lesson):
+    render_cache.invalidate(("homework_menu", class_id), ("homework_all", class_id), ("homework_day", class_id, day),
+                            ("reminder", class_id, day))
+    # Экраны уроков закэшированы по номеру урока в дне (см. render_homework_by_lesson)
+    render_cache.invalidate_prefix("homework_lesson", class_id, day)
+
+
+async def render_schedule(class_id):
+    schedule = await storage.get_schedule(class_id)
+    if not schedule:
+        return None
+
+    message = "Расписание на неделю:\n"
+    for day, lessons in schedule.items():
+        message += f"\n{day.capitalize()}:\n"
+        for lesson in lessons:
+            message += f"- {lesson}\n"
+    return message, None
+
+
+async def render_homework_menu(class_id):
+    homework = await storage.get_homework(class_id)
+    if not homework:
+        return None
+
+    keyboard = [[InlineKeyboardButton("Все ДЗ на неделю", callback_data=router.data("homework_all"))]]
+    for day in homework.keys():
+        keyboard.append([InlineKeyboardButton(f"ДЗ на {day.capitalize()}", callback_data=router.data("hwd", day))])
+    return "Выберите день:", InlineKeyboardMarkup(keyboard)
+
+
+async def render_all_homework(class_id):
+    homework = await storage.get_homework(class_id)
+    if not homework:
+        return None
+
+    message = "Домашнее задание на неделю:\n"
+    for day, tasks in homework.items():
+        message += f"\n{day.capitalize()}:\n"
+        for lesson, task in tasks.items():
+            message += f"- {lesson}: {task}\n"
+    keyboard = [[InlineKeyboardButton("Назад", callback_data=router.data("hw"))]]
+    return message, InlineKeyboardMarkup(keyboard)
+
+
+async def render_homework_by_day(class_id, day):
+    homework = await storage.get_homework_day(class_id, day)
+    if not homework:
+        return None
+
+    message = f"Домашнее задание на {day.capitalize()}:\n"
+    for lesson, task in homework.items():
+        message += f"- {lesson}: {task}\n"
+
+    # Урок в кнопке — его номер в дне: название урока по-русски быстро превышает
+    # 64 байта callback_data, а номер не зависит от памяти процесса
+    keyboard = []
+    for number, lesson in enumerate(homework.keys()):
+        keyboard.append(
+            [InlineKeyboardButton(f"ДЗ по {lesson.capitalize()}", callback_data=router.data("hwl", day, number))])
+
+    keyboard.append([InlineKeyboardButton("Назад", callback_data=router.data("hw"))])
+    return message, InlineKeyboardMarkup(keyboard)
+
+
+async def render_homework_by_lesson(class_id, day, number):
+    lessons = list((await storage.get_homework_day(class_id, day) or {}).items())
+    if not 0 <= number < len(lessons):
+        return None
+
+    lesson, homework = lessons[number]
+    message = f"ДЗ на {day.capitalize()} по {lesson.capitalize()}:\n{homework}"
+    keyboard = [[InlineKeyboardButton("Назад", callback_data=router.data("hwd", day))]]
+    return message, InlineKeyboardMarkup(keyboard)
+
+
+async def render_reminder(class_id, day):
+    lessons = (await storage.get_schedule(class_id)).get(day, [])
+    homework = dict(await storage.get_homework_day(class_id, day) or {})
+    if not lessons and not homework:
+        return None
+
+    message = f"Завтра {day}.\n"
+    if lessons:
+        message += "\nУроки:\n"
+        for lesson in lessons:
+            task = homework.pop(lesson.strip().lower(), None)
+            message += f"- {lesson.strip()}: {task}\n" if task else f"- {lesson.strip()}\n"
+    if homework:
+        message += "\nДомашнее задание:\n"
+        for lesson, task in homework.items():
+            message += f"- {lesson}: {task}\n"
+    return message, None
+
+
+async def reminder_text(class_id, day):
+    """Текст напоминания для ReminderScheduler: один на класс и день, пока админ не изменит данные."""
+    view = await render_cache.get(("reminder", class_id, day), lambda: render_reminder(class_id, day))
+    return view[0] if view is not None else None
+
+
+@timed
+async def show_schedule(update: Update, context: CallbackContext, class_id):
     try:
         user_id = update.effective_user.id
-        data = load_data()
-        schedule = data["schedule"]
-        if not schedule:
-            context.bot.send_message(chat_id=user_id, text="Расписание пока не задано.")
+        view = await render_cache.get(("schedule", class_id), lambda: render_schedule(class_id))
+        if view is None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Расписание пока не задано.")
             return
 
-        message = "Расписание на неделю:\n"
-        for day, lessons in schedule.items():
-            message += f"\n{day.capitalize()}:\n"
-            for lesson in lessons:
-                message += f"- {lesson}\n"
-        context.bot.send_message(chat_id=user_id, text=message)
+        message, reply_markup = view
+        await context.bot_data['replies'].show(update, message, reply_markup)
     except Exception as e:
         logging.error(f"Error in show_schedule: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def show_homework_menu(update: Update, context: CallbackContext):
+@timed
+async def show_homework_menu(update: Update, context: CallbackContext, class_id):
     try:
         user_id = update.effective_user.id
-        keyboard = []
-        data = load_data()
-        if not data["homework"]:
-            context.bot.send_message(chat_id=user_id, text="Домашнее задание пока не задано.")
+        view = await render_cache.get(("homework_menu", class_id), lambda: render_homework_menu(class_id))
+        if view is None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Домашнее задание пока не задано.")
             return
 
-        keyboard.append([InlineKeyboardButton("Все ДЗ на неделю", callback_data="homework_all")])
-        for day in data["homework"].keys():
-            keyboard.append([InlineKeyboardButton(f"ДЗ на {day.capitalize()}", callback_data=f"homework_{day}")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(
-            chat_id=user_id, text="Выберите день:", reply_markup=reply_markup
-        )
+        message, reply_markup = view
+        await context.bot_data['replies'].show(update, message, reply_markup)
     except Exception as e:
         logging.error(f"Error in show_homework_menu: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def show_homework_by_day(update: Update, context: CallbackContext, day):
+@timed
+async def show_all_homework(update: Update, context: CallbackContext, class_id):
     try:
         user_id = update.effective_user.id
-        data = load_data()
-        homework = data["homework"].get(day)
-        if not homework:
-            context.bot.send_message(chat_id=user_id, text="Нет ДЗ на этот день")
+        view = await render_cache.get(("homework_all", class_id), lambda: render_all_homework(class_id))
+        if view is None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Домашнее задание пока не задано.")
             return
-        message = f"Домашнее задание на {day.capitalize()}:\n"
-        for lesson, task in homework.items():
-            message += f"- {lesson}: {task}\n"
 
-        keyboard = []
-        for lesson in homework.keys():
-            keyboard.append(
-                [InlineKeyboardButton(f"ДЗ по {lesson.capitalize()}", callback_data=f"homework_{day}_{lesson}")])
+        message, reply_markup = view
+        await context.bot_data['replies'].show(update, message, reply_markup)
+    except Exception as e:
+        logging.error(f"Error in show_all_homework: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
-        keyboard.append([InlineKeyboardButton("Назад", callback_data='homework')])
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=user_id, text=message, reply_markup=reply_markup)
+@timed
+async def show_homework_by_day(update: Update, context: CallbackContext, class_id, day):
+    try:
+        user_id = update.effective_user.id
+        view = await render_cache.get(("homework_day", class_id, day), lambda: render_homework_by_day(class_id, day))
+        if view is None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Нет ДЗ на этот день")
+            return
+
+        message, reply_markup = view
+        await context.bot_data['replies'].show(update, message, reply_markup)
     except Exception as e:
         logging.error(f"Error in show_homework_by_day: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def show_homework_by_lesson(update: Update, context: CallbackContext, day, lesson):
+@timed
+async def show_homework_by_lesson(update: Update, context: CallbackContext, class_id, day, number):
     try:
         user_id = update.effective_user.id
-        data = load_data()
-        homework = data["homework"].get(day, {}).get(lesson)
-        if not homework:
-            context.bot.send_message(chat_id=user_id, text="Нет такого дз")
+        view = await render_cache.get(("homework_lesson", class_id, day, number),
+                                      lambda: render_homework_by_lesson(class_id, day, number))
+        if view is None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Нет такого дз")
             return
-        message = f"ДЗ на {day.capitalize()} по {lesson.capitalize()}:\n{homework}"
-        keyboard = [[InlineKeyboardButton("Назад", callback_data=f'homework_{day}')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=user_id, text=message, reply_markup=reply_markup)
+
+        message, reply_markup = view
+        await context.bot_data['replies'].show(update, message, reply_markup)
     except Exception as e:
         logging.error(f"Error in show_homework_by_lesson: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def send_feedback(update: Update, context: CallbackContext):
+@timed
+async def send_feedback(update: Update, context: CallbackContext, class_id):
     try:
         user_id = update.effective_user.id
-        context.bot.send_message(
+        await context.bot_data['replies'].send(
             chat_id=user_id, text="Напишите ваше сообщение для администратора:"
         )
-        context.user_data['feedback_mode'] = True
+        await context.bot_data['conversations'].set(user_id, State.FEEDBACK)
     except Exception as e:
         logging.error(f"Error in send_feedback: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def show_admin_menu(update: Update, context: CallbackContext):
+@timed
+async def show_reminder_settings(update: Update, context: CallbackContext, class_id):
     try:
         user_id = update.effective_user.id
-        if user_id == ADMIN_ID:
-            keyboard = [
-                [InlineKeyboardButton("Одобрить заявки", callback_data="approve_user")],
-                [InlineKeyboardButton("Добавить расписание", callback_data="add_schedule")],
-                [InlineKeyboardButton("Добавить ДЗ", callback_data="add_homework")],
-                [InlineKeyboardButton("Отправить объявление", callback_data="send_announcement")],
-                [InlineKeyboardButton("Просмотреть обратную связь", callback_data="view_feedback")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            context.bot.send_message(
-                chat_id=user_id, text="Админ панель:", reply_markup=reply_markup
-            )
+        user = await get_user(user_id)
+        reminder = user['reminder'] if user is not None else None
+        if reminder:
+            message = f"Напоминание о расписании и ДЗ на завтра приходит каждый день в {reminder}."
         else:
-            context.bot.send_message(chat_id=user_id, text="У вас нет прав администратора.")
+            message = "Напоминание о расписании и ДЗ на завтра выключено."
+        message += "\nВыберите время или отправьте /reminder ЧЧ:ММ"
+
+        keyboard = [[InlineKeyboardButton(reminder_time, callback_data=router.data("rem", reminder_time))
+                     for reminder_time in REMINDER_TIMES]]
+        if reminder:
+            keyboard.append([InlineKeyboardButton("Выключить", callback_data=router.data("remoff"))])
+        await context.bot_data['replies'].show(update, message, InlineKeyboardMarkup(keyboard))
     except Exception as e:
-        logging.error(f"Error in show_admin_menu: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        logging.error(f"Error in show_reminder_settings: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def show_admin_feedback(update: Update, context: CallbackContext):
+@timed
+async def set_reminder_time(update: Update, context: CallbackContext, class_id, reminder_time=None):
     try:
         user_id = update.effective_user.id
-        if user_id == ADMIN_ID:
-            data = load_data()
-            if not data['feedback']:
-                context.bot.send_message(chat_id=user_id, text="Нет обратной связи")
+        if reminder_time is not None:
+            try:
+                reminder_time = datetime.datetime.strptime(reminder_time, "%H:%M").strftime("%H:%M")
+            except ValueError:
+                await context.bot_data['replies'].send(chat_id=user_id, text="Неверный формат времени. Например: /reminder 19:30")
                 return
+        await storage.set_reminder(user_id, reminder_time)
+        if reminder_time:
+            message = f"Готово: каждый день в {reminder_time} пришлю расписание и ДЗ на завтра."
+        else:
+            message = "Напоминание выключено."
+        await context.bot_data['replies'].show(update, message)
+    except Exception as e:
+        logging.error(f"Error in set_reminder_time: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
-            for item in data['feedback']:
-                keyboard = [[InlineKeyboardButton("Ответить", callback_data=f"reply_feedback_{item['id']}")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                context.bot.send_message(chat_id=user_id,
-                                         text=f"ID: {item['id']}\nСообщение от {item['user_id']}:\n{item['text']}",
-                                         reply_markup=reply_markup)
 
-            keyboard = [[InlineKeyboardButton("Назад", callback_data="admin_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            context.bot.send_message(chat_id=user_id, text="Выберите сообщение для ответа", reply_markup=reply_markup)
+@timed
+async def reminder_command(update: Update, context: CallbackContext):
+    # /reminder — настройки, /reminder 19:30 — включить, /reminder off — выключить
+    try:
+        user_id = update.effective_user.id
+        user = await get_user(user_id)
+        if user is None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Сначала зарегистрируйтесь: /start")
+        elif not context.args:
+            await show_reminder_settings(update, context, user['class'])
+        elif context.args[0].lower() in ("off", "выкл"):
+            await set_reminder_time(update, context, user['class'])
+        else:
+            await set_reminder_time(update, context, user['class'], context.args[0])
+    except Exception as e:
+        logging.error(f"Error in reminder_command: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+async def search_homework(update: Update, context: CallbackContext, class_id, query):
+    try:
+        words, since, until = parse_query(query, datetime.date.today())
+    except ValueError:
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id,
+                                               text="Не удалось разобрать даты. Укажите дату как 01.09 или период как 01.09-15.09")
+        return
+    if not words and since is None:
+        await context.bot_data['replies'].send(
+            chat_id=update.effective_user.id,
+            text="Поиск по истории ДЗ:\n"
+                 "/search математика - по уроку или словам из задания\n"
+                 "/search 01.09-15.09 - заданное за эти дни\n"
+                 "/search параграф 01.09-15.09 - и то и другое",
+        )
+        return
+
+    found = await storage.search_homework(class_id, words, since, until, SEARCH_LIMIT)
+    if not found:
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Ничего не найдено.")
+        return
+    message = f"Последние {SEARCH_LIMIT} найденных ДЗ:" if len(found) == SEARCH_LIMIT else "Найденные ДЗ:"
+    for item in found:
+        date = datetime.date.fromisoformat(item['date']).strftime("%d.%m.%Y")
+        message += f"\n{date}, {item['day']}, {item['lesson']}: {preview(item['task'])}"
+    await context.bot_data['replies'].send(chat_id=update.effective_user.id, text=message)
+
+
+async def search_feedback(update: Update, context: CallbackContext, class_id, args):
+    # Числа в запросе — ID пользователя, остальное — слова из текста
+    user_filter = None
+    words = []
+    for arg in args:
+        if arg.isdigit():
+            user_filter = int(arg)
+        else:
+            words += tokenize(arg)
+    if not words and user_filter is None:
+        await context.bot_data['replies'].send(
+            chat_id=update.effective_user.id,
+            text="Поиск по обратной связи:\n"
+                 "/search feedback оценки - по словам из сообщения\n"
+                 "/search feedback 123456789 - сообщения пользователя с этим ID",
+        )
+        return
+
+    found = await storage.search_feedback(class_id, words, user_filter, SEARCH_LIMIT)
+    if not found:
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Ничего не найдено.")
+        return
+    message = (f"Последние {SEARCH_LIMIT} найденных сообщений:\n" if len(found) == SEARCH_LIMIT
+               else "Найденные сообщения:\n")
+    for item in found:
+        status = "отвечено" if item.get('answered') else "без ответа"
+        message += f"\nID: {item['id']}, от {item['user_id']} ({status}):\n{preview(item['text'])}\n"
+    await context.bot_data['replies'].send(chat_id=update.effective_user.id, text=message)
+
+
+@timed
+async def search_command(update: Update, context: CallbackContext):
+    # /search <слова> [дата или период] — история ДЗ, /search feedback <слова или ID> — обратная связь
+    try:
+        user_id = update.effective_user.id
+        user = await get_user(user_id)
+        if user is None:
+            await context.bot_data['replies'].send(chat_id=user_id, text="Сначала зарегистрируйтесь: /start")
+        elif context.args and context.args[0].lower() == "feedback":
+            if allowed(ADMIN, user):
+                await search_feedback(update, context, user['class'], context.args[1:])
+            else:
+                await context.bot_data['replies'].send(chat_id=user_id, text="У вас нет прав администратора.")
+        else:
+            await search_homework(update, context, user['class'], " ".join(context.args))
+    except Exception as e:
+        logging.error(f"Error in search_command: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+@timed
+async def show_admin_menu(update: Update, context: CallbackContext, class_id):
+    try:
+        keyboard = [
+            [InlineKeyboardButton("Одобрить заявки", callback_data=router.data("pend", 0))],
+            [InlineKeyboardButton("Добавить расписание", callback_data=router.data("sch"))],
+            [InlineKeyboardButton("Добавить ДЗ", callback_data=router.data("hwadd"))],
+            [InlineKeyboardButton("Загрузить из файла", callback_data=router.data("imp")),
+             InlineKeyboardButton("Выгрузить в файл", callback_data=router.data("exp", "csv"))],
+            [InlineKeyboardButton("Отправить объявление", callback_data=router.data("ann"))],
+            [InlineKeyboardButton("Просмотреть обратную связь", callback_data=router.data("fb", 0))],
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await context.bot_data['replies'].show(update, f"Админ панель (класс {class_id}):", reply_markup)
+    except Exception as e:
+        logging.error(f"Error in show_admin_menu: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+@timed
+async def show_admin_feedback(update: Update, context: CallbackContext, class_id, page=0):
+    try:
+        total = await storage.count_unanswered_feedback(class_id)
+        if not total:
+            await context.bot_data['replies'].show(update, "Нет обратной связи",
+                            InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=router.data("adm"))]]))
+            return
+
+        pages = page_count(total)
+        page = min(page, pages - 1)
+        feedback = await storage.list_unanswered_feedback(class_id, page * PAGE_SIZE, PAGE_SIZE)
+
+        message = f"Обратная связь без ответа (страница {page + 1} из {pages}, всего {total}):\n"
+        buttons = []
+        for item in feedback:
+            message += f"\nID: {item['id']}, от {item['user_id']}:\n{preview(item['text'])}\n"
+            buttons.append(InlineKeyboardButton(f"Ответить #{item['id']}",
+                                                callback_data=router.data("fbr", class_id, item['id'])))
+        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        keyboard.append([InlineKeyboardButton(
+            "Отметить страницу отвеченной",
+            callback_data=router.data("fbd", class_id, feedback[0]['id'], feedback[-1]['id'], page))])
+        navigation = page_navigation("fb", page, pages)
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("В админ панель", callback_data=router.data("adm"))])
+        await context.bot_data['replies'].show(update, message, InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logging.error(f"Error in show_admin_feedback: {e}", exc_info=True)
-        context.bot.send_message(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
 
 
-def main():
-    updater = Updater(TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
+@timed
+async def mark_feedback_answered(update: Update, context: CallbackContext, class_id, first_id, last_id, page):
+    try:
+        await storage.mark_feedback_answered(class_id, first_id, last_id)
+        await show_admin_feedback(update, context, class_id, page)
+    except Exception as e:
+        logging.error(f"Error in mark_feedback_answered: {e}", exc_info=True)
+        await context.bot_data['replies'].send(chat_id=update.effective_user.id, text="Произошла ошибка. Попробуйте позже")
+
+
+# Кнопки и пункты меню: callback_data (или текст кнопки) -> обработчик и кто может его вызвать
+router.add("Расписание", show_schedule)
+router.add("Домашнее задание", show_homework_menu)
+router.add("Обратная связь", send_feedback)
+router.add("Напоминания", show_reminder_settings)
+router.add("rem:{reminder_time}", set_reminder_time)
+router.add("remoff", set_reminder_time)
+router.add("reg:{name}", choose_class, GUEST)
+router.add("hw", show_homework_menu)
+router.add("homework_all", show_all_homework)
+router.add("hwd:{day}", show_homework_by_day)
+router.add("hwl:{day}:{number:int}", show_homework_by_lesson)
+router.add("adm", show_admin_menu, ADMIN)
+router.add("pend:{page:int}", show_pending_users, ADMIN)
+router.add("ap:{class_id}:{user_id:int}", approve_user, ADMIN)
+router.add("apg:{class_id}:{user_ids}:{page:int}", approve_page, ADMIN)
+router.add("sch", ask_schedule, ADMIN)
+router.add("hwadd", ask_homework, ADMIN)
+router.add("imp", ask_import, ADMIN)
+router.add("exp:{fmt}", export_week, ADMIN)
+router.add("ann", ask_announcement, ADMIN)
+router.add("fb:{page:int}", show_admin_feedback, ADMIN)
+router.add("fbd:{class_id}:{first_id:int}:{last_id:int}:{page:int}", mark_feedback_answered, ADMIN)
+router.add("fbr:{class_id}:{feedback_id:int}", ask_feedback_reply, ADMIN)
+
+
+async def post_init(application: Application):
+    await storage.start()
+    await initialize_admin()
+    application.bot_data['replies'] = Replies(application.bot)
+
+    # Процессы бота работают с общей базой: состояние диалогов читается из неё
+    # (пользователь может перейти в другой процесс), а данные классов в кэше
+    # экранов сверяются с версией базы
+    clustered = WORKER_ID is not None
+    conversations = Conversations(storage, cached=not clustered)
+    application.bot_data['conversations'] = conversations
+    await conversations.restore()
+    if clustered:
+        render_cache.versions = storage.class_version
+
+    broadcaster = Broadcaster(application.bot, storage,
+                              poll_interval=BROADCAST_POLL_INTERVAL if clustered else None)
+    application.bot_data['broadcaster'] = broadcaster
+
+    reminders = ReminderScheduler(storage, broadcaster, reminder_text)
+    application.bot_data['reminders'] = reminders
+
+    if clustered:
+        # Рассылки и напоминания выполняет один процесс — тот, у кого аренда
+        async def start_background():
+            broadcaster.start()
+            reminders.start()
+
+        async def stop_background():
+            await reminders.stop()
+            await broadcaster.stop()
+
+        lease = Lease(storage, "background", start_background, stop_background)
+        application.bot_data['lease'] = lease
+        lease.start()
+    else:
+        broadcaster.start()
+        reminders.start()
+
+    metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT, METRICS_LOG_INTERVAL)
+    application.bot_data['metrics_server'] = metrics_server
+    await metrics_server.start()
 
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CallbackQueryHandler(button))
-    dispatcher.add_handler(CommandHandler("admin", admin_command))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
 
-    data = initialize_admin()
+async def post_stop(application: Application):
+    # Накопленные ответы отправляются, пока соединение с Bot API ещё открыто
+    await application.bot_data['replies'].close()
 
-    updater.start_polling()
-    updater.idle()
+
+async def post_shutdown(application: Application):
+    await application.bot_data['metrics_server'].stop()
+    if 'lease' in application.bot_data:
+        await application.bot_data['lease'].stop()
+    await application.bot_data['reminders'].stop()
+    await application.bot_data['broadcaster'].stop()
+    await storage.close()
+
+
+def webhook_available():
+    # Встроенный webhook-сервер python-telegram-bot работает на tornado
+    if importlib.util.find_spec("tornado") is None:
+        logging.warning("Webhook mode needs python-telegram-bot[webhooks], falling back to polling")
+        return False
+    return True
+
+
+def build_application(builder):
+    application = (
+        builder
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(button))
+    application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(CommandHandler("classes", classes_command))
+    application.add_handler(CommandHandler("reminder", reminder_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler(["import", "export"], transfer_command))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    return application
+
+
+def main():
+    global WORKER_ID, METRICS_PORT
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        # python scbot.py migrate [data.json] [data.db]
+        json_path = sys.argv[2] if len(sys.argv) > 2 else DATABASE_FILE
+        sqlite_path = sys.argv[3] if len(sys.argv) > 3 else SQLITE_FILE
+        counts = migrate_json_to_sqlite(json_path, sqlite_path, CLASSES_DIR, DEFAULT_CLASS)
+        print(f"Migrated {json_path} -> {sqlite_path}: {counts}")
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "compact":
+        # python scbot.py compact — перенести старые записи журнала в архив
+        archived = storage.storage.compact()
+        storage.storage.close()
+        print(f"Compacted storage, {archived} records archived")
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "workers":
+        # python scbot.py workers [N] — N рабочих процессов над общей базой SQLite
+        if STORAGE_BACKEND != "sqlite":
+            print('Several workers need STORAGE_BACKEND = "sqlite" (run "python scbot.py migrate" first)')
+            return
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else WORKERS
+        # Классы и главный админ создаются один раз, а не каждым процессом одновременно;
+        # дальше главный процесс с базой не работает
+        asyncio.run(initialize_admin())
+        storage.storage.close()
+        asyncio.run(run_cluster(
+            Bot(TOKEN, request=InstrumentedRequest(), get_updates_request=InstrumentedRequest()),
+            count,
+            lambda index: [sys.executable, os.path.abspath(__file__), "worker", str(index)],
+            WORKER_HOST,
+            WORKER_BASE_PORT,
+            MetricsServer(METRICS_HOST, METRICS_PORT, METRICS_LOG_INTERVAL),
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}" if WEBHOOK_URL else None,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET or None,
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+        ))
+        return
+    if len(sys.argv) > 2 and sys.argv[1] == "worker":
+        # Запускается из "workers": обновления приходят от главного процесса
+        WORKER_ID = int(sys.argv[2])
+        if METRICS_PORT:
+            METRICS_PORT += 1 + WORKER_ID
+        application = build_application(
+            Application.builder()
+            .token(TOKEN)
+            .updater(None)
+            .request(InstrumentedRequest(connection_pool_size=CONNECTION_POOL_SIZE))
+        )
+        asyncio.run(run_worker(application, WORKER_HOST, WORKER_BASE_PORT + WORKER_ID))
+        return
+
+    application = build_application(
+        Application.builder()
+        .token(TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=CONNECTION_POOL_SIZE))
+        .get_updates_request(InstrumentedRequest())
+    )
+
+    if WEBHOOK_URL and "polling" not in sys.argv[1:] and webhook_available():
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
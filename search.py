@@ -0,0 +1,83 @@
+"""Поиск по истории ДЗ и обратной связи (/search).
+
+Слова запроса ищутся как префиксы: "матем" находит "математика" и
+"математике". Хранилище JSON держит InvertedIndex в памяти, SQLite —
+таблицы FTS5; слова разбиваются одинаково (tokenize), поэтому оба
+хранилища находят одно и то же.
+"""
+import bisect
+import datetime
+import re
+
+WORD = re.compile(r"[^\W_]+")  # Как токенизатор unicode61 в FTS5: буквы и цифры
+DATE = re.compile(r"\b(\d{1,2})\.(\d{1,2})(?:\.(\d{4}|\d{2}))?\b")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def fts_query(words):
+    """Запрос FTS5 MATCH: все слова, каждое как префикс."""
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class InvertedIndex:
+    """Инвертированный индекс: слово -> id документов.
+
+    Документ индексируется при добавлении, пересчёта всего индекса не
+    бывает. Словарь слов хранится отсортированным, чтобы слова с нужным
+    префиксом находились двоичным поиском.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._words = []
+
+    def add(self, doc_id, text):
+        for word in set(tokenize(text)):
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                bisect.insort(self._words, word)
+            postings.add(doc_id)
+
+    def _prefixed(self, prefix):
+        ids = set()
+        for i in range(bisect.bisect_left(self._words, prefix), len(self._words)):
+            if not self._words[i].startswith(prefix):
+                break
+            ids |= self._postings[self._words[i]]
+        return ids
+
+    def search(self, words):
+        """id документов, в которых есть слово с каждым из префиксов words."""
+        result = None
+        for prefix in words:
+            ids = self._prefixed(prefix)
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return result or set()
+
+
+def _date(match, today):
+    day, month, year = int(match.group(1)), int(match.group(2)), match.group(3)
+    if year is not None:
+        return datetime.date(int(year) + (2000 if len(year) == 2 else 0), month, day)
+    # Без года — ближайшая прошедшая такая дата (учебный год переходит через январь)
+    date = datetime.date(today.year, month, day)
+    return date if date <= today else date.replace(year=today.year - 1)
+
+
+def parse_query(text, today):
+    """(слова, с даты, по дату) из запроса вида "математика 01.09-15.09".
+    Одна дата — поиск за этот день; даты — строки ISO или None.
+    Несуществующая дата — ValueError."""
+    dates = sorted(_date(match, today) for match in DATE.finditer(text))
+    if len(dates) > 2:
+        raise ValueError("too many dates")
+    words = tokenize(DATE.sub(" ", text))
+    if not dates:
+        return words, None, None
+    return words, dates[0].isoformat(), dates[-1].isoformat()
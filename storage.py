@@ -0,0 +1,1547 @@
+import asyncio
+import datetime
+import functools
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+from search import InvertedIndex, fts_query
+
+DATABASE_FILE = "data.json"
+SQLITE_FILE = "data.db"
+CLASSES_DIR = "classes"  # Каталог с файлами классов (по файлу на класс)
+DEFAULT_CLASS = "основной"  # Класс, в который переносятся данные базы без классов
+JOURNAL_FILE = "journal.jsonl"  # Журнал базы без классов, переносится в файл класса
+FLUSH_INTERVAL = 2.0  # Как часто (в секундах) изменения сбрасываются на диск
+COMPACT_EVERY = 1000  # После скольких записей в журнал он уплотняется
+KEEP_ANNOUNCEMENTS = 100  # Сколько последних объявлений остаётся в журнале при уплотнении
+
+# Название класса становится именем файла и частью callback_data
+CLASS_NAME_PATTERN = re.compile(r"[\w-]{1,16}")
+
+UMASK = os.umask(0)  # Права новых файлов базы, как у файлов, созданных open()
+os.umask(UMASK)
+
+
+def valid_class_name(name):
+    return CLASS_NAME_PATTERN.fullmatch(name) is not None
+
+
+def empty_data():
+    return {
+        "classes": [],
+        "users": {},  # id пользователя -> класс
+        "admins": [],  # id админов (каждый управляет своим классом)
+        "pending": {},  # id заявки -> класс
+        "reminders": {},  # id пользователя -> время ежедневного напоминания "ЧЧ:ММ"
+        "conversations": {},  # id пользователя -> [шаг диалога, параметр, срок действия]
+        "broadcasts": [],
+        "next_broadcast_id": 1,  # Номера рассылок не повторяются и после их завершения
+    }
+
+
+def empty_class_data():
+    return {
+        "pending_users": {},
+        "schedule": {},
+        "homework": {},
+    }
+
+
+def is_legacy_data(data):
+    # data.json до появления классов: список пользователей и данные класса в корне
+    return isinstance(data.get("users"), list) or "schedule" in data
+
+
+def load_data(path=DATABASE_FILE):
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+            for key in ("pending_users", "pending", "reminders", "conversations"):
+                if key in data:
+                    data[key] = {int(k): v for k, v in data[key].items()}
+            if isinstance(data.get("users"), dict):
+                data["users"] = {int(k): v for k, v in data["users"].items()}
+            elif "users" in data:
+                data["users"] = [int(user) for user in data["users"]]
+            return data
+
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def dump_data(data):
+    data_to_save = data.copy()
+
+    if "pending_users" in data_to_save:
+        data_to_save["pending_users"] = {str(k): v for k, v in data_to_save["pending_users"].items()}
+
+    return json.dumps(data_to_save, indent=4)
+
+
+def write_file_atomic(path, text):
+    # Пишем во временный файл рядом и атомарно подменяем им базу,
+    # чтобы падение посреди записи не оставило обрезанный data.json
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".data-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp создаёт файл с правами 0600: оставляем права, которые были у базы
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if os.name == "posix":
+        # Переименование попадает на диск вместе с записью каталога
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def save_data(data, path=DATABASE_FILE):
+    write_file_atomic(path, dump_data(data))
+
+
+class Journal:
+    """Журнал только на дозапись (JSON Lines) для обратной связи, объявлений
+    и истории ДЗ.
+
+    Новая запись дописывается одной строкой в конец файла, поэтому её
+    стоимость не зависит от размера базы. compact() переносит отвеченную
+    обратную связь, историю ДЗ и старые объявления в архив и переписывает
+    журнал, сохраняя счётчики id, чтобы id никогда не повторялись.
+    Обратная связь и история ДЗ из архива читаются при открытии для поиска.
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.archive_path = f"{os.path.splitext(path)[0]}.archive.jsonl"
+        self.feedback = {}  # id -> запись, в порядке id
+        self.unanswered = {}
+        self.archived_feedback = {}
+        self.announcements = []
+        self.homework_history = {}  # id -> запись, в порядке id (и дат)
+        self.unarchived_homework = []  # id записей истории, которые ещё в журнале
+        self.feedback_index = InvertedIndex()
+        self.homework_index = InvertedIndex()
+        self.next_feedback_id = 1
+        self.next_announcement_id = 1
+        self.next_homework_id = 1
+        self.appended = 0  # Записей с последнего уплотнения
+        self._load_archive()
+        self._replay()
+        self._file = open(path, "a", encoding="utf-8")
+        self._unsynced = False
+
+    def _load_archive(self):
+        try:
+            with open(self.archive_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record["op"] == "feedback":
+                        self.archived_feedback[record['id']] = {
+                            'id': record['id'], 'user_id': record['user_id'], 'text': record['text'], 'answered': True}
+                        self.feedback_index.add(record['id'], record['text'])
+                    elif record["op"] == "homework":
+                        self._add_history(record)
+        except FileNotFoundError:
+            pass
+        self.unarchived_homework = []
+
+    def _add_history(self, record):
+        item = {key: record[key] for key in ('id', 'date', 'day', 'lesson', 'task')}
+        self.homework_history[item['id']] = item
+        self.unarchived_homework.append(item['id'])
+        self.homework_index.add(item['id'], f"{item['lesson']} {item['task']}")
+        self.next_homework_id = max(self.next_homework_id, item['id'] + 1)
+
+    def _replay(self):
+        try:
+            with open(self.path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        # Последняя строка без перевода строки — запись, оборванная падением
+        complete = content[:content.rfind(b"\n") + 1]
+        if len(complete) != len(content):
+            logging.warning(f"Dropping truncated record at the end of {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(len(complete))
+        for line in complete.decode("utf-8").splitlines():
+            if line:
+                record = json.loads(line)
+                self._apply(record)
+                # Записи, которые переписало уплотнение, новыми не считаются
+                self.appended = -record.get('records', 0) if record['op'] == 'seq' else self.appended + 1
+
+    def _apply(self, record):
+        op = record["op"]
+        if op == "seq":
+            self.next_feedback_id = max(self.next_feedback_id, record["feedback"])
+            self.next_announcement_id = max(self.next_announcement_id, record["announcement"])
+            self.next_homework_id = max(self.next_homework_id, record.get("homework", 1))
+        elif op == "feedback":
+            item = {'id': record['id'], 'user_id': record['user_id'], 'text': record['text']}
+            if record.get('answered'):
+                item['answered'] = True
+            else:
+                self.unanswered[item['id']] = item
+            self.feedback[item['id']] = item
+            self.feedback_index.add(item['id'], item['text'])
+            self.next_feedback_id = max(self.next_feedback_id, item['id'] + 1)
+        elif op == "answered":
+            for feedback_id in [i for i in self.unanswered if record["first_id"] <= i <= record["last_id"]]:
+                self.unanswered.pop(feedback_id)['answered'] = True
+        elif op == "announcement":
+            self.announcements.append({'id': record['id'], 'text': record['text']})
+            self.next_announcement_id = max(self.next_announcement_id, record['id'] + 1)
+        elif op == "homework":
+            self._add_history(record)
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self._file.write(line)
+        self._file.flush()
+        self._apply(record)
+        self.appended += 1
+        self._unsynced = True
+        metrics.inc("journal_appends_total", op=record["op"])
+        metrics.inc("journal_bytes_total", len(line.encode()))
+
+    def add_feedback(self, user_id, text):
+        feedback_id = self.next_feedback_id
+        self.append({'op': 'feedback', 'id': feedback_id, 'user_id': user_id, 'text': text})
+        return feedback_id
+
+    def mark_answered(self, first_id, last_id):
+        count = sum(1 for i in self.unanswered if first_id <= i <= last_id)
+        if count:
+            self.append({'op': 'answered', 'first_id': first_id, 'last_id': last_id})
+        return count
+
+    def add_announcement(self, text):
+        announcement_id = self.next_announcement_id
+        self.append({'op': 'announcement', 'id': announcement_id, 'text': text})
+        return announcement_id
+
+    def add_homework(self, day, lesson, task):
+        self.append({'op': 'homework', 'id': self.next_homework_id, 'date': datetime.date.today().isoformat(),
+                     'day': day, 'lesson': lesson, 'task': task})
+
+    def sync(self):
+        if self._unsynced:
+            self._unsynced = False
+            os.fsync(self._file.fileno())
+
+    def _records(self, feedback, announcements, homework=()):
+        for item in feedback:
+            yield {'op': 'feedback', **item}
+        for item in announcements:
+            yield {'op': 'announcement', **item}
+        for item in homework:
+            yield {'op': 'homework', **item}
+
+    def compact(self, keep_announcements=KEEP_ANNOUNCEMENTS):
+        """Переносит в архив отвеченную обратную связь, историю ДЗ и все
+        объявления, кроме keep_announcements последних. Возвращает число
+        перенесённых записей."""
+        archived_feedback = [item for item in self.feedback.values() if item.get('answered')]
+        split = max(0, len(self.announcements) - keep_announcements)
+        archived_announcements = self.announcements[:split]
+        archived_homework = [self.homework_history[i] for i in self.unarchived_homework]
+
+        if archived_feedback or archived_announcements or archived_homework:
+            with open(self.archive_path, "a", encoding="utf-8") as f:
+                for record in self._records(archived_feedback, archived_announcements, archived_homework):
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.archived_feedback.update((item['id'], item) for item in archived_feedback)
+        self.feedback = {i: item for i, item in self.feedback.items() if not item.get('answered')}
+        self.announcements = self.announcements[split:]
+        self.unarchived_homework = []
+        records = [json.dumps(record, ensure_ascii=False)
+                   for record in self._records(self.feedback.values(), self.announcements)]
+        lines = [json.dumps({'op': 'seq', 'feedback': self.next_feedback_id, 'announcement': self.next_announcement_id,
+                             'homework': self.next_homework_id, 'records': len(records)})] + records
+        self._file.close()
+        write_file_atomic(self.path, "\n".join(lines) + "\n")
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._unsynced = False
+        self.appended = 0
+        return len(archived_feedback) + len(archived_announcements) + len(archived_homework)
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class Storage:
+    """Интерфейс хранилища бота.
+
+    Обработчики в scbot.py работают только через эти методы, поэтому
+    хранилище можно менять (JSON-файл, SQLite), не трогая логику бота.
+
+    Данные разделены по классам. Общий реестр хранит список классов,
+    класс каждого пользователя, админов и рассылки; всё остальное
+    (заявки, расписание, ДЗ, обратная связь, объявления) лежит в отдельном
+    шарде класса (shard), который открывается при первом обращении.
+    Методы с class_id первым аргументом работают только с шардом этого класса.
+    """
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def compact(self):
+        """Уплотняет хранилище, если backend это поддерживает."""
+        return 0
+
+    def list_classes(self):
+        raise NotImplementedError
+
+    def has_class(self, class_id):
+        raise NotImplementedError
+
+    def add_class(self, class_id):
+        """Создаёт класс, если его ещё нет. Возвращает True, если класс создан."""
+        raise NotImplementedError
+
+    def shard(self, class_id):
+        """Данные одного класса: объект с методами Storage без class_id."""
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        """{'class': ..., 'admin': ..., 'reminder': ...} или None, если пользователь не зарегистрирован."""
+        raise NotImplementedError
+
+    def is_user(self, user_id):
+        return self.get_user(user_id) is not None
+
+    def add_user(self, class_id, user_id):
+        """Добавляет пользователя в класс (или переводит из другого класса)."""
+        raise NotImplementedError
+
+    def set_admin(self, user_id, admin=True):
+        """Делает пользователя админом его класса или снимает права."""
+        raise NotImplementedError
+
+    def list_users(self, class_id=None):
+        """Пользователи класса или, если class_id не задан, всего бота."""
+        raise NotImplementedError
+
+    def remove_user(self, user_id):
+        raise NotImplementedError
+
+    def set_reminder(self, user_id, reminder_time):
+        """Подписывает на ежедневное напоминание в reminder_time ("ЧЧ:ММ") или отписывает (None)."""
+        raise NotImplementedError
+
+    def list_reminder_users(self, reminder_time):
+        """[(id пользователя, класс)] для всех, кто подписан на напоминание в reminder_time."""
+        raise NotImplementedError
+
+    def set_conversation(self, user_id, state, arg=None, expires=None):
+        """Запоминает шаг диалога пользователя; state=None — диалог завершён."""
+        raise NotImplementedError
+
+    def get_conversation(self, user_id):
+        """(шаг, параметр, срок действия) диалога пользователя или None."""
+        raise NotImplementedError
+
+    def list_conversations(self):
+        """[(id пользователя, шаг, параметр, срок действия)] всех начатых диалогов."""
+        raise NotImplementedError
+
+    def purge_conversations(self, now):
+        """Удаляет диалоги, срок действия которых истёк к now. Возвращает их число."""
+        raise NotImplementedError
+
+    def acquire_lease(self, name, owner, ttl):
+        """Берёт или продлевает на ttl секунд аренду name для процесса owner.
+        Возвращает True, если аренда у owner (её нет ни у кого другого)."""
+        raise NotImplementedError
+
+    def release_lease(self, name, owner):
+        raise NotImplementedError
+
+    def class_version(self, class_id):
+        """Меняется, когда данные класса изменил другой процесс (для сброса кэшей)."""
+        return 0
+
+    def get_pending_class(self, user_id):
+        """Класс, в который подана заявка пользователя, или None."""
+        raise NotImplementedError
+
+    def _set_pending_class(self, user_id, class_id):
+        raise NotImplementedError
+
+    def add_pending(self, class_id, user_id, name, surname):
+        self.shard(class_id).add_pending(user_id, name, surname)
+        self._set_pending_class(user_id, class_id)
+
+    def count_pending(self, class_id):
+        return self.shard(class_id).count_pending()
+
+    def list_pending(self, class_id, offset=0, limit=None):
+        """Заявки в порядке поступления: {user_id: {'name': ..., 'surname': ...}}."""
+        return self.shard(class_id).list_pending(offset, limit)
+
+    def approve_pending(self, class_id, user_id):
+        """Переносит пользователя из заявок в пользователи класса.
+
+        Возвращает данные заявки ({'name': ..., 'surname': ...}) или None,
+        если такой заявки нет.
+        """
+        pending = self.shard(class_id).pop_pending(user_id)
+        if pending is not None:
+            self.add_user(class_id, user_id)
+        return pending
+
+    def get_schedule(self, class_id):
+        return self.shard(class_id).get_schedule()
+
+    def set_schedule_day(self, class_id, day, lessons):
+        self.shard(class_id).set_schedule_day(day, lessons)
+
+    def get_homework(self, class_id):
+        return self.shard(class_id).get_homework()
+
+    def get_homework_day(self, class_id, day):
+        return self.shard(class_id).get_homework_day(day)
+
+    def get_homework_lesson(self, class_id, day, lesson):
+        return self.shard(class_id).get_homework_lesson(day, lesson)
+
+    def set_homework(self, class_id, day, lesson, task):
+        """Записывает ДЗ и добавляет его в историю ДЗ с сегодняшней датой."""
+        self.shard(class_id).set_homework(day, lesson, task)
+
+    def import_week(self, class_id, schedule, homework):
+        """Заменяет расписание дней из schedule и записывает ДЗ из homework одной транзакцией."""
+        self.shard(class_id).import_week(schedule, homework)
+
+    def search_homework(self, class_id, words, since=None, until=None, limit=None):
+        """История ДЗ класса, новые записи первыми: словари id, date, day,
+        lesson, task. words — слова (префиксы) из урока или текста ДЗ,
+        since/until — даты ISO, включительно."""
+        return self.shard(class_id).search_homework(words, since, until, limit)
+
+    def search_feedback(self, class_id, words, user_id=None, limit=None):
+        """Обратная связь класса, в том числе отвеченная, новые сообщения первыми."""
+        return self.shard(class_id).search_feedback(words, user_id, limit)
+
+    def add_feedback(self, class_id, user_id, text):
+        """Сохраняет сообщение обратной связи и возвращает его id (свой в каждом классе)."""
+        return self.shard(class_id).add_feedback(user_id, text)
+
+    def get_feedback(self, class_id, feedback_id):
+        return self.shard(class_id).get_feedback(feedback_id)
+
+    def list_feedback(self, class_id):
+        return self.shard(class_id).list_feedback()
+
+    def count_unanswered_feedback(self, class_id):
+        return self.shard(class_id).count_unanswered_feedback()
+
+    def list_unanswered_feedback(self, class_id, offset=0, limit=None):
+        """Неотвеченные сообщения в порядке id."""
+        return self.shard(class_id).list_unanswered_feedback(offset, limit)
+
+    def mark_feedback_answered(self, class_id, first_id, last_id):
+        """Отмечает отвеченными сообщения с id от first_id до last_id
+        включительно и возвращает, сколько отметок поставлено."""
+        return self.shard(class_id).mark_feedback_answered(first_id, last_id)
+
+    def add_announcement(self, class_id, text):
+        self.shard(class_id).add_announcement(text)
+
+    def list_announcements(self, class_id):
+        return self.shard(class_id).list_announcements()
+
+    def create_broadcast(self, text, admin_id, recipients):
+        """Ставит рассылку в очередь и возвращает её id."""
+        raise NotImplementedError
+
+    def list_broadcasts(self):
+        """Незавершённые рассылки: словари с ключами id, text, admin_id,
+        recipients, position, sent, failed, pruned."""
+        raise NotImplementedError
+
+    def update_broadcast(self, broadcast_id, position, sent, failed, pruned):
+        raise NotImplementedError
+
+    def finish_broadcast(self, broadcast_id):
+        raise NotImplementedError
+
+
+class JsonFile:
+    """Словарь в памяти с отложенной атомарной записью в JSON-файл.
+
+    Изменения выполняются под self.lock и помечают файл «грязным»;
+    flush() сохраняет накопившиеся изменения одной записью.
+    """
+
+    def __init__(self, path, lock, empty):
+        self.path = path
+        self.lock = lock
+        self.data = load_data(path)
+        for key, value in empty.items():
+            self.data.setdefault(key, value)
+        self._dirty = False
+
+    def mark_dirty(self):
+        with self.lock:
+            self._dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            text = dump_data(self.data)
+        started = time.perf_counter()
+        try:
+            write_file_atomic(self.path, text)
+        except Exception:
+            self.mark_dirty()
+            raise
+        metrics.observe("storage_flush_seconds", time.perf_counter() - started)
+        metrics.set_gauge("storage_file_bytes", len(text.encode()), file=os.path.basename(self.path))
+
+
+class JsonShard(JsonFile):
+    """Данные одного класса: заявки, расписание и ДЗ в <класс>.json,
+    обратная связь и объявления в журнале <класс>.jsonl."""
+
+    def __init__(self, path, journal_path, lock):
+        super().__init__(path, lock, empty_class_data())
+        self.journal = Journal(journal_path)
+
+    def move_to_journal(self, feedback, announcements):
+        # Старый data.json хранил эти коллекции целиком: переносим их в журнал один раз
+        for item in feedback:
+            if item['id'] not in self.journal.feedback:
+                self.journal.append({'op': 'feedback', 'id': item['id'], 'user_id': item['user_id'],
+                                     'text': item['text'], 'answered': bool(item.get('answered'))})
+        for text in announcements:
+            self.journal.add_announcement(text)
+        self.journal.sync()
+
+    def flush(self):
+        with self.lock:
+            self.journal.sync()
+            if self.journal.appended >= COMPACT_EVERY:
+                self.compact()
+        super().flush()
+
+    def compact(self):
+        with self.lock:
+            return self.journal.compact()
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+
+    def add_pending(self, user_id, name, surname):
+        with self.lock:
+            self.data["pending_users"][int(user_id)] = {'name': name, 'surname': surname}
+            self.mark_dirty()
+
+    def count_pending(self):
+        return len(self.data["pending_users"])
+
+    def list_pending(self, offset=0, limit=None):
+        with self.lock:
+            items = self.data["pending_users"].items()
+            stop = offset + limit if limit is not None else None
+            return dict(itertools.islice(items, offset, stop))
+
+    def pop_pending(self, user_id):
+        with self.lock:
+            pending = self.data["pending_users"].pop(int(user_id), None)
+            if pending is not None:
+                self.mark_dirty()
+            return pending
+
+    def get_schedule(self):
+        # Копии: вызывающие читают их в цикле событий, пока поток хранилища пишет
+        with self.lock:
+            return {day: list(lessons) for day, lessons in self.data["schedule"].items()}
+
+    def set_schedule_day(self, day, lessons):
+        with self.lock:
+            self.data["schedule"][day] = list(lessons)
+            self.mark_dirty()
+
+    def get_homework(self):
+        with self.lock:
+            return {day: dict(tasks) for day, tasks in self.data["homework"].items()}
+
+    def get_homework_day(self, day):
+        with self.lock:
+            tasks = self.data["homework"].get(day)
+            return dict(tasks) if tasks is not None else None
+
+    def get_homework_lesson(self, day, lesson):
+        return self.data["homework"].get(day, {}).get(lesson)
+
+    def set_homework(self, day, lesson, task):
+        with self.lock:
+            self.data["homework"].setdefault(day, {})[lesson] = task
+            self.journal.add_homework(day, lesson, task)
+            self.mark_dirty()
+
+    def import_week(self, schedule, homework):
+        with self.lock:
+            for day, lessons in schedule.items():
+                self.data["schedule"][day] = list(lessons)
+            for day, tasks in homework.items():
+                self.data["homework"].setdefault(day, {}).update(tasks)
+                for lesson, task in tasks.items():
+                    self.journal.add_homework(day, lesson, task)
+            self.mark_dirty()
+
+    def search_homework(self, words, since=None, until=None, limit=None):
+        with self.lock:
+            history = self.journal.homework_history
+            ids = self.journal.homework_index.search(words) if words else history.keys()
+            found = (history[i] for i in sorted(ids, reverse=True))
+            found = (item for item in found
+                     if (since is None or item['date'] >= since) and (until is None or item['date'] <= until))
+            return [dict(item) for item in itertools.islice(found, limit)]
+
+    def search_feedback(self, words, user_id=None, limit=None):
+        with self.lock:
+            journal = self.journal
+            ids = journal.feedback_index.search(words) if words else {*journal.feedback, *journal.archived_feedback}
+            found = (journal.feedback.get(i) or journal.archived_feedback[i] for i in sorted(ids, reverse=True))
+            found = (item for item in found if user_id is None or item['user_id'] == user_id)
+            return [dict(item) for item in itertools.islice(found, limit)]
+
+    def add_feedback(self, user_id, text):
+        with self.lock:
+            return self.journal.add_feedback(user_id, text)
+
+    def get_feedback(self, feedback_id):
+        item = self.journal.feedback.get(feedback_id)
+        return dict(item) if item is not None else None
+
+    def list_feedback(self):
+        with self.lock:
+            return [dict(item) for item in self.journal.feedback.values()]
+
+    def count_unanswered_feedback(self):
+        return len(self.journal.unanswered)
+
+    def list_unanswered_feedback(self, offset=0, limit=None):
+        with self.lock:
+            stop = offset + limit if limit is not None else None
+            return [dict(item) for item in itertools.islice(self.journal.unanswered.values(), offset, stop)]
+
+    def mark_feedback_answered(self, first_id, last_id):
+        with self.lock:
+            return self.journal.mark_answered(first_id, last_id)
+
+    def add_announcement(self, text):
+        with self.lock:
+            self.journal.add_announcement(text)
+
+    def list_announcements(self):
+        with self.lock:
+            return [item['text'] for item in self.journal.announcements]
+
+
+class JsonStorage(JsonFile, Storage):
+    """Данные бота в памяти процесса с отложенной записью на диск.
+
+    data.json — общий реестр (классы, пользователи, админы, рассылки),
+    данные каждого класса — в classes/<класс>.json и classes/<класс>.jsonl
+    (см. JsonShard). Файлы читаются при первом обращении, чтения
+    обслуживаются из памяти; фоновый поток раз в flush_interval секунд
+    сохраняет все изменённые файлы атомарной записью.
+    """
+
+    def __init__(self, path=DATABASE_FILE, flush_interval=FLUSH_INTERVAL, classes_dir=CLASSES_DIR,
+                 default_class=DEFAULT_CLASS):
+        super().__init__(path, threading.RLock(), empty_data())
+        self.flush_interval = flush_interval
+        self.classes_dir = classes_dir
+        self._shards = {}
+        self._leases = {}  # Данные в памяти одного процесса, поэтому и аренды только в памяти
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(classes_dir, exist_ok=True)
+        if is_legacy_data(self.data):
+            self._split_legacy(default_class)
+        # Индексы поверх data.json, чтобы не искать перебором
+        self._classes = set(self.data["classes"])
+        self._admins = set(self.data["admins"])
+        self._class_users = {class_id: {} for class_id in self._classes}
+        for user_id, class_id in self.data["users"].items():
+            self._class_users.setdefault(class_id, {})[user_id] = None
+        self._reminder_users = {}  # время -> {id пользователя: None}
+        for user_id, reminder_time in self.data["reminders"].items():
+            self._reminder_users.setdefault(reminder_time, {})[user_id] = None
+
+    def _split_legacy(self, default_class):
+        # База до появления классов: всё, кроме рассылок, становится классом по умолчанию
+        legacy = self.data
+        self.data = empty_data()
+        self.data["classes"] = [default_class]
+        self.data["users"] = {user_id: default_class for user_id in legacy.get("users", [])}
+        self.data["pending"] = {user_id: default_class for user_id in legacy.get("pending_users", {})}
+        self.data["broadcasts"] = legacy.get("broadcasts", [])
+
+        shard_path, journal_path = self._shard_paths(default_class)
+        legacy_journal = os.path.join(os.path.dirname(os.path.abspath(self.path)), JOURNAL_FILE)
+        if os.path.exists(legacy_journal) and not os.path.exists(journal_path):
+            os.replace(legacy_journal, journal_path)
+            legacy_archive = f"{os.path.splitext(legacy_journal)[0]}.archive.jsonl"
+            if os.path.exists(legacy_archive):
+                os.replace(legacy_archive, f"{os.path.splitext(journal_path)[0]}.archive.jsonl")
+        shard = JsonShard(shard_path, journal_path, self.lock)
+        for key in empty_class_data():
+            shard.data[key] = legacy.get(key, {})
+        shard.move_to_journal(legacy.get("feedback", []), legacy.get("announcements", []))
+        shard.mark_dirty()
+        shard.flush()
+        self._shards[default_class] = shard
+        self.mark_dirty()
+        self.flush()
+        logging.info(f"Moved single-class data from {self.path} to class {default_class}")
+
+    def _shard_paths(self, class_id):
+        base = os.path.join(self.classes_dir, class_id)
+        return f"{base}.json", f"{base}.jsonl"
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="storage-flush", daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        for shard in list(self._shards.values()):
+            shard.flush()
+        super().flush()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        super().flush()
+        for shard in self._shards.values():
+            shard.close()
+
+    def compact(self):
+        archived = sum(self.shard(class_id).compact() for class_id in self.list_classes())
+        logging.info(f"Journals compacted, {archived} records archived")
+        return archived
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error while saving data: {e}", exc_info=True)
+
+    def list_classes(self):
+        with self.lock:
+            return list(self.data["classes"])
+
+    def has_class(self, class_id):
+        return class_id in self._classes
+
+    def add_class(self, class_id):
+        if not valid_class_name(class_id):
+            raise ValueError(f"Invalid class name: {class_id!r}")
+        with self.lock:
+            if class_id in self._classes:
+                return False
+            self._classes.add(class_id)
+            self._class_users.setdefault(class_id, {})
+            self.data["classes"].append(class_id)
+            self.mark_dirty()
+            return True
+
+    def shard(self, class_id):
+        shard = self._shards.get(class_id)
+        if shard is None:
+            if class_id not in self._classes:
+                raise KeyError(f"Unknown class: {class_id}")
+            with self.lock:
+                shard = self._shards.get(class_id)
+                if shard is None:
+                    shard = self._shards[class_id] = JsonShard(*self._shard_paths(class_id), self.lock)
+        return shard
+
+    def get_user(self, user_id):
+        class_id = self.data["users"].get(int(user_id))
+        if class_id is None:
+            return None
+        return {'class': class_id, 'admin': int(user_id) in self._admins,
+                'reminder': self.data["reminders"].get(int(user_id))}
+
+    def add_user(self, class_id, user_id):
+        user_id = int(user_id)
+        with self.lock:
+            previous = self.data["users"].get(user_id)
+            if previous != class_id:
+                if previous is not None:
+                    self._class_users[previous].pop(user_id, None)
+                self.data["users"][user_id] = class_id
+                self._class_users[class_id][user_id] = None
+                self.mark_dirty()
+            if self.data["pending"].pop(user_id, None) is not None:
+                self.mark_dirty()
+
+    def set_admin(self, user_id, admin=True):
+        user_id = int(user_id)
+        with self.lock:
+            if admin and user_id not in self._admins:
+                self._admins.add(user_id)
+                self.data["admins"].append(user_id)
+                self.mark_dirty()
+            elif not admin and user_id in self._admins:
+                self._admins.discard(user_id)
+                self.data["admins"].remove(user_id)
+                self.mark_dirty()
+
+    def list_users(self, class_id=None):
+        with self.lock:
+            if class_id is None:
+                return list(self.data["users"])
+            return list(self._class_users.get(class_id, ()))
+
+    def remove_user(self, user_id):
+        user_id = int(user_id)
+        with self.lock:
+            class_id = self.data["users"].pop(user_id, None)
+            if class_id is not None:
+                self._class_users[class_id].pop(user_id, None)
+                self.set_admin(user_id, False)
+                self.set_reminder(user_id, None)
+                self.mark_dirty()
+
+    def set_reminder(self, user_id, reminder_time):
+        user_id = int(user_id)
+        with self.lock:
+            previous = self.data["reminders"].pop(user_id, None)
+            if previous is not None:
+                self._reminder_users[previous].pop(user_id, None)
+            if reminder_time is not None:
+                self.data["reminders"][user_id] = reminder_time
+                self._reminder_users.setdefault(reminder_time, {})[user_id] = None
+            if previous != reminder_time:
+                self.mark_dirty()
+
+    def list_reminder_users(self, reminder_time):
+        with self.lock:
+            return [(user_id, self.data["users"][user_id])
+                    for user_id in self._reminder_users.get(reminder_time, ())
+                    if user_id in self.data["users"]]
+
+    def set_conversation(self, user_id, state, arg=None, expires=None):
+        user_id = int(user_id)
+        with self.lock:
+            if state is None:
+                if self.data["conversations"].pop(user_id, None) is None:
+                    return
+            else:
+                self.data["conversations"][user_id] = [state, arg, expires]
+            self.mark_dirty()
+
+    def get_conversation(self, user_id):
+        entry = self.data["conversations"].get(int(user_id))
+        return tuple(entry) if entry is not None else None
+
+    def list_conversations(self):
+        with self.lock:
+            return [(user_id, *entry) for user_id, entry in self.data["conversations"].items()]
+
+    def purge_conversations(self, now):
+        with self.lock:
+            expired = [user_id for user_id, entry in self.data["conversations"].items() if entry[2] < now]
+            for user_id in expired:
+                del self.data["conversations"][user_id]
+            if expired:
+                self.mark_dirty()
+            return len(expired)
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self.lock:
+            holder, expires = self._leases.get(name, (owner, 0))
+            if holder != owner and expires >= now:
+                return False
+            self._leases[name] = (owner, now + ttl)
+            return True
+
+    def release_lease(self, name, owner):
+        with self.lock:
+            if self._leases.get(name, (None,))[0] == owner:
+                del self._leases[name]
+
+    def get_pending_class(self, user_id):
+        return self.data["pending"].get(int(user_id))
+
+    def _set_pending_class(self, user_id, class_id):
+        with self.lock:
+            self.data["pending"][int(user_id)] = class_id
+            self.mark_dirty()
+
+    def create_broadcast(self, text, admin_id, recipients):
+        with self.lock:
+            broadcast_id = max(self.data["next_broadcast_id"],
+                               max((item['id'] for item in self.data["broadcasts"]), default=0) + 1)
+            self.data["next_broadcast_id"] = broadcast_id + 1
+            self.data["broadcasts"].append({
+                'id': broadcast_id,
+                'text': text,
+                'admin_id': admin_id,
+                'recipients': list(recipients),
+                'position': 0,
+                'sent': 0,
+                'failed': 0,
+                'pruned': 0,
+            })
+            self.mark_dirty()
+            return broadcast_id
+
+    def list_broadcasts(self):
+        with self.lock:
+            return [dict(item) for item in self.data["broadcasts"]]
+
+    def update_broadcast(self, broadcast_id, position, sent, failed, pruned):
+        with self.lock:
+            for item in self.data["broadcasts"]:
+                if item['id'] == broadcast_id:
+                    item.update(position=position, sent=sent, failed=failed, pruned=pruned)
+                    self.mark_dirty()
+
+    def finish_broadcast(self, broadcast_id):
+        with self.lock:
+            self.data["broadcasts"] = [item for item in self.data["broadcasts"] if item['id'] != broadcast_id]
+            self.mark_dirty()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS classes (
+    class_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    class_id TEXT NOT NULL,
+    admin INTEGER NOT NULL DEFAULT 0,
+    reminder TEXT
+);
+CREATE INDEX IF NOT EXISTS users_class_id ON users (class_id);
+CREATE INDEX IF NOT EXISTS users_reminder ON users (reminder) WHERE reminder IS NOT NULL;
+CREATE TABLE IF NOT EXISTS pending (
+    user_id INTEGER PRIMARY KEY,
+    class_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    arg,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    admin_id INTEGER NOT NULL,
+    recipients TEXT NOT NULL,
+    position INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    pruned INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+SQLITE_CLASS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_users (
+    user_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    surname TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS schedule (
+    day TEXT PRIMARY KEY,
+    lessons TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS homework (
+    day TEXT NOT NULL,
+    lesson TEXT NOT NULL,
+    task TEXT NOT NULL,
+    PRIMARY KEY (day, lesson)
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    answered INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS feedback_user_id ON feedback (user_id);
+CREATE INDEX IF NOT EXISTS feedback_answered ON feedback (answered, id);
+CREATE TABLE IF NOT EXISTS announcements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS homework_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    day TEXT NOT NULL,
+    lesson TEXT NOT NULL,
+    task TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS homework_history_date ON homework_history (date);
+CREATE VIRTUAL TABLE IF NOT EXISTS homework_search USING fts5(
+    lesson, task, content='homework_history', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS homework_history_indexed AFTER INSERT ON homework_history BEGIN
+    INSERT INTO homework_search (rowid, lesson, task) VALUES (new.id, new.lesson, new.task);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS feedback_search USING fts5(
+    text, content='feedback', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS feedback_indexed AFTER INSERT ON feedback BEGIN
+    INSERT INTO feedback_search (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+
+class SqliteDatabase:
+    """Соединение SQLite с блокировкой и короткими обёртками для запросов."""
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._upgrade_schema()
+        self.conn.executescript(schema)
+        self.conn.commit()
+
+    def _upgrade_schema(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _execute(self, sql, params=()):
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params)
+
+
+class SqliteShard(SqliteDatabase):
+    """Данные одного класса в отдельном файле classes/<класс>.db.
+
+    Порядок дней и уроков сохраняется через rowid (обновления делаются
+    через UPSERT, который rowid не меняет).
+    """
+
+    def __init__(self, path):
+        super().__init__(path, SQLITE_CLASS_SCHEMA)
+        if self._index_feedback:
+            # Обратная связь, сохранённая до появления поиска, попадает в индекс один раз
+            self._execute("INSERT INTO feedback_search (feedback_search) VALUES ('rebuild')")
+
+    def _upgrade_schema(self):
+        tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self._index_feedback = "feedback" in tables and "feedback_search" not in tables
+
+    def compact(self):
+        return 0
+
+    def add_pending(self, user_id, name, surname):
+        self._execute(
+            "INSERT INTO pending_users (user_id, name, surname) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, surname = excluded.surname",
+            (int(user_id), name, surname),
+        )
+
+    def count_pending(self):
+        return self._query("SELECT COUNT(*) FROM pending_users")[0][0]
+
+    def list_pending(self, offset=0, limit=None):
+        rows = self._query(
+            "SELECT user_id, name, surname FROM pending_users ORDER BY rowid LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset),
+        )
+        return {user: {'name': name, 'surname': surname} for user, name, surname in rows}
+
+    def pop_pending(self, user_id):
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT name, surname FROM pending_users WHERE user_id = ?", (int(user_id),)
+            ).fetchone()
+            if row is None:
+                return None
+            # Заявку одобряет тот, чей DELETE её удалил: другой процесс мог успеть раньше
+            if self.conn.execute("DELETE FROM pending_users WHERE user_id = ?", (int(user_id),)).rowcount == 0:
+                return None
+            return {'name': row[0], 'surname': row[1]}
+
+    def get_schedule(self):
+        rows = self._query("SELECT day, lessons FROM schedule ORDER BY rowid")
+        return {day: json.loads(lessons) for day, lessons in rows}
+
+    def set_schedule_day(self, day, lessons):
+        self._execute(
+            "INSERT INTO schedule (day, lessons) VALUES (?, ?) "
+            "ON CONFLICT (day) DO UPDATE SET lessons = excluded.lessons",
+            (day, json.dumps(list(lessons))),
+        )
+
+    def get_homework(self):
+        homework = {}
+        for day, lesson, task in self._query("SELECT day, lesson, task FROM homework ORDER BY rowid"):
+            homework.setdefault(day, {})[lesson] = task
+        return homework
+
+    def get_homework_day(self, day):
+        rows = self._query("SELECT lesson, task FROM homework WHERE day = ? ORDER BY rowid", (day,))
+        return dict(rows) or None
+
+    def get_homework_lesson(self, day, lesson):
+        rows = self._query("SELECT task FROM homework WHERE day = ? AND lesson = ?", (day, lesson))
+        return rows[0][0] if rows else None
+
+    def set_homework(self, day, lesson, task):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO homework (day, lesson, task) VALUES (?, ?, ?) "
+                "ON CONFLICT (day, lesson) DO UPDATE SET task = excluded.task",
+                (day, lesson, task),
+            )
+            self.conn.execute("INSERT INTO homework_history (date, day, lesson, task) VALUES (?, ?, ?, ?)",
+                              (datetime.date.today().isoformat(), day, lesson, task))
+
+    def import_week(self, schedule, homework):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO schedule (day, lessons) VALUES (?, ?) "
+                "ON CONFLICT (day) DO UPDATE SET lessons = excluded.lessons",
+                [(day, json.dumps(list(lessons))) for day, lessons in schedule.items()],
+            )
+            rows = [(day, lesson, task) for day, tasks in homework.items() for lesson, task in tasks.items()]
+            self.conn.executemany(
+                "INSERT INTO homework (day, lesson, task) VALUES (?, ?, ?) "
+                "ON CONFLICT (day, lesson) DO UPDATE SET task = excluded.task",
+                rows,
+            )
+            today = datetime.date.today().isoformat()
+            self.conn.executemany("INSERT INTO homework_history (date, day, lesson, task) VALUES (?, ?, ?, ?)",
+                                  [(today, *row) for row in rows])
+
+    def search_homework(self, words, since=None, until=None, limit=None):
+        sql = "SELECT h.id, h.date, h.day, h.lesson, h.task FROM homework_history h"
+        conditions, params = [], []
+        if words:
+            sql += " JOIN homework_search ON homework_search.rowid = h.id"
+            conditions.append("homework_search MATCH ?")
+            params.append(fts_query(words))
+        if since is not None:
+            conditions.append("h.date >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("h.date <= ?")
+            params.append(until)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        rows = self._query(sql + " ORDER BY h.id DESC LIMIT ?", (*params, -1 if limit is None else limit))
+        return [{'id': id_, 'date': date, 'day': day, 'lesson': lesson, 'task': task}
+                for id_, date, day, lesson, task in rows]
+
+    def search_feedback(self, words, user_id=None, limit=None):
+        sql = "SELECT f.id, f.user_id, f.text, f.answered FROM feedback f"
+        conditions, params = [], []
+        if words:
+            sql += " JOIN feedback_search ON feedback_search.rowid = f.id"
+            conditions.append("feedback_search MATCH ?")
+            params.append(fts_query(words))
+        if user_id is not None:
+            conditions.append("f.user_id = ?")
+            params.append(user_id)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        rows = self._query(sql + " ORDER BY f.id DESC LIMIT ?", (*params, -1 if limit is None else limit))
+        return [{'id': id_, 'user_id': user, 'text': text, **({'answered': True} if answered else {})}
+                for id_, user, text, answered in rows]
+
+    def add_feedback(self, user_id, text):
+        cursor = self._execute("INSERT INTO feedback (user_id, text) VALUES (?, ?)", (user_id, text))
+        return cursor.lastrowid
+
+    def get_feedback(self, feedback_id):
+        rows = self._query("SELECT id, user_id, text FROM feedback WHERE id = ?", (feedback_id,))
+        if not rows:
+            return None
+        return {'id': rows[0][0], 'user_id': rows[0][1], 'text': rows[0][2]}
+
+    def list_feedback(self):
+        rows = self._query("SELECT id, user_id, text, answered FROM feedback ORDER BY id")
+        return [{'id': id_, 'user_id': user, 'text': text, **({'answered': True} if answered else {})}
+                for id_, user, text, answered in rows]
+
+    def count_unanswered_feedback(self):
+        return self._query("SELECT COUNT(*) FROM feedback WHERE answered = 0")[0][0]
+
+    def list_unanswered_feedback(self, offset=0, limit=None):
+        rows = self._query(
+            "SELECT id, user_id, text FROM feedback WHERE answered = 0 ORDER BY id LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset),
+        )
+        return [{'id': id_, 'user_id': user, 'text': text} for id_, user, text in rows]
+
+    def mark_feedback_answered(self, first_id, last_id):
+        cursor = self._execute(
+            "UPDATE feedback SET answered = 1 WHERE answered = 0 AND id BETWEEN ? AND ?",
+            (first_id, last_id),
+        )
+        return cursor.rowcount
+
+    def add_announcement(self, text):
+        self._execute("INSERT INTO announcements (text) VALUES (?)", (text,))
+
+    def list_announcements(self):
+        return [row[0] for row in self._query("SELECT text FROM announcements ORDER BY id")]
+
+
+class SqliteStorage(SqliteDatabase, Storage):
+    """Хранилище в SQLite: общий реестр в data.db, данные каждого класса —
+    в отдельной базе classes/<класс>.db (см. SqliteShard)."""
+
+    def __init__(self, path=SQLITE_FILE, classes_dir=CLASSES_DIR, default_class=DEFAULT_CLASS):
+        self.classes_dir = classes_dir
+        self.default_class = default_class
+        self._shards = {}
+        os.makedirs(classes_dir, exist_ok=True)
+        super().__init__(path, SQLITE_SCHEMA)
+
+    def _shard_path(self, class_id):
+        return os.path.join(self.classes_dir, f"{class_id}.db")
+
+    def _upgrade_schema(self):
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if columns and "class_id" not in columns:
+            self._split_legacy()
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if columns and "reminder" not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN reminder TEXT")
+
+    def _split_legacy(self):
+        # База до появления классов: таблицы класса переезжают в файл класса
+        # по умолчанию, а users и pending_users получают колонку class_id
+        class_id = self.default_class
+        shard_path = self._shard_path(class_id)
+        SqliteShard(shard_path).close()
+        feedback_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(feedback)")}
+        answered = "answered" if "answered" in feedback_columns else "0"
+        self.conn.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+        try:
+            self.conn.execute("BEGIN")
+            for sql in (
+                "INSERT OR REPLACE INTO shard.pending_users SELECT user_id, name, surname FROM main.pending_users "
+                "ORDER BY rowid",
+                "INSERT OR REPLACE INTO shard.schedule SELECT day, lessons FROM main.schedule ORDER BY rowid",
+                "INSERT OR REPLACE INTO shard.homework SELECT day, lesson, task FROM main.homework ORDER BY rowid",
+                f"INSERT OR REPLACE INTO shard.feedback SELECT id, user_id, text, {answered} FROM main.feedback",
+                "INSERT OR REPLACE INTO shard.announcements SELECT id, text FROM main.announcements",
+                "CREATE TABLE users_by_class (user_id INTEGER PRIMARY KEY, class_id TEXT NOT NULL, "
+                "admin INTEGER NOT NULL DEFAULT 0)",
+                "INSERT INTO users_by_class (user_id, class_id) SELECT user_id, :class FROM users ORDER BY rowid",
+                "DROP TABLE users",
+                "ALTER TABLE users_by_class RENAME TO users",
+                "CREATE TABLE pending (user_id INTEGER PRIMARY KEY, class_id TEXT NOT NULL)",
+                "INSERT INTO pending SELECT user_id, :class FROM pending_users",
+                "CREATE TABLE classes (class_id TEXT PRIMARY KEY)",
+                "INSERT INTO classes VALUES (:class)",
+                "DROP TABLE pending_users",
+                "DROP TABLE schedule",
+                "DROP TABLE homework",
+                "DROP TABLE feedback",
+                "DROP TABLE announcements",
+            ):
+                self.conn.execute(sql, {"class": class_id} if ":class" in sql else {})
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.execute("DETACH DATABASE shard")
+        logging.info(f"Moved single-class data from {self.path} to class {class_id}")
+
+    def close(self):
+        with self.lock:
+            for shard in self._shards.values():
+                shard.close()
+            self.conn.close()
+
+    def list_classes(self):
+        return [row[0] for row in self._query("SELECT class_id FROM classes ORDER BY rowid")]
+
+    def has_class(self, class_id):
+        return bool(self._query("SELECT 1 FROM classes WHERE class_id = ?", (class_id,)))
+
+    def add_class(self, class_id):
+        if not valid_class_name(class_id):
+            raise ValueError(f"Invalid class name: {class_id!r}")
+        return self._execute("INSERT OR IGNORE INTO classes (class_id) VALUES (?)", (class_id,)).rowcount == 1
+
+    def shard(self, class_id):
+        shard = self._shards.get(class_id)
+        if shard is None:
+            if not self.has_class(class_id):
+                raise KeyError(f"Unknown class: {class_id}")
+            with self.lock:
+                shard = self._shards.get(class_id)
+                if shard is None:
+                    shard = self._shards[class_id] = SqliteShard(self._shard_path(class_id))
+        return shard
+
+    def get_user(self, user_id):
+        rows = self._query("SELECT class_id, admin, reminder FROM users WHERE user_id = ?", (int(user_id),))
+        if not rows:
+            return None
+        return {'class': rows[0][0], 'admin': bool(rows[0][1]), 'reminder': rows[0][2]}
+
+    def add_user(self, class_id, user_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO users (user_id, class_id) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET class_id = excluded.class_id",
+                (int(user_id), class_id),
+            )
+            self.conn.execute("DELETE FROM pending WHERE user_id = ?", (int(user_id),))
+
+    def set_admin(self, user_id, admin=True):
+        self._execute("UPDATE users SET admin = ? WHERE user_id = ?", (int(admin), int(user_id)))
+
+    def list_users(self, class_id=None):
+        if class_id is None:
+            return [row[0] for row in self._query("SELECT user_id FROM users ORDER BY rowid")]
+        rows = self._query("SELECT user_id FROM users WHERE class_id = ? ORDER BY rowid", (class_id,))
+        return [row[0] for row in rows]
+
+    def remove_user(self, user_id):
+        self._execute("DELETE FROM users WHERE user_id = ?", (int(user_id),))
+
+    def set_reminder(self, user_id, reminder_time):
+        self._execute("UPDATE users SET reminder = ? WHERE user_id = ?", (reminder_time, int(user_id)))
+
+    def list_reminder_users(self, reminder_time):
+        return self._query("SELECT user_id, class_id FROM users WHERE reminder = ? ORDER BY rowid", (reminder_time,))
+
+    def set_conversation(self, user_id, state, arg=None, expires=None):
+        if state is None:
+            self._execute("DELETE FROM conversations WHERE user_id = ?", (int(user_id),))
+        else:
+            self._execute("INSERT OR REPLACE INTO conversations (user_id, state, arg, expires) VALUES (?, ?, ?, ?)",
+                          (int(user_id), state, arg, expires))
+
+    def get_conversation(self, user_id):
+        rows = self._query("SELECT state, arg, expires FROM conversations WHERE user_id = ?", (int(user_id),))
+        return rows[0] if rows else None
+
+    def list_conversations(self):
+        return self._query("SELECT user_id, state, arg, expires FROM conversations")
+
+    def purge_conversations(self, now):
+        return self._execute("DELETE FROM conversations WHERE expires < ?", (now,)).rowcount
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self.lock, self.conn:
+            # INSERT открывает пишущую транзакцию, так что UPDATE ниже не пересечётся с другим процессом
+            self.conn.execute("INSERT OR IGNORE INTO leases (name, owner, expires) VALUES (?, ?, 0)", (name, owner))
+            cursor = self.conn.execute(
+                "UPDATE leases SET owner = ?, expires = ? WHERE name = ? AND (owner = ? OR expires < ?)",
+                (owner, now + ttl, name, owner, now),
+            )
+            return cursor.rowcount == 1
+
+    def release_lease(self, name, owner):
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def class_version(self, class_id):
+        # data_version меняется, только когда базу класса изменило другое соединение
+        return self.shard(class_id)._query("PRAGMA data_version")[0][0]
+
+    def get_pending_class(self, user_id):
+        rows = self._query("SELECT class_id FROM pending WHERE user_id = ?", (int(user_id),))
+        return rows[0][0] if rows else None
+
+    def _set_pending_class(self, user_id, class_id):
+        self._execute("INSERT OR REPLACE INTO pending (user_id, class_id) VALUES (?, ?)", (int(user_id), class_id))
+
+    def create_broadcast(self, text, admin_id, recipients):
+        cursor = self._execute(
+            "INSERT INTO broadcasts (text, admin_id, recipients) VALUES (?, ?, ?)",
+            (text, admin_id, json.dumps(list(recipients))),
+        )
+        return cursor.lastrowid
+
+    def list_broadcasts(self):
+        rows = self._query(
+            "SELECT id, text, admin_id, recipients, position, sent, failed, pruned FROM broadcasts ORDER BY id"
+        )
+        return [
+            {'id': id_, 'text': text, 'admin_id': admin_id, 'recipients': json.loads(recipients),
+             'position': position, 'sent': sent, 'failed': failed, 'pruned': pruned}
+            for id_, text, admin_id, recipients, position, sent, failed, pruned in rows
+        ]
+
+    def update_broadcast(self, broadcast_id, position, sent, failed, pruned):
+        self._execute(
+            "UPDATE broadcasts SET position = ?, sent = ?, failed = ?, pruned = ? WHERE id = ?",
+            (position, sent, failed, pruned, broadcast_id),
+        )
+
+    def finish_broadcast(self, broadcast_id):
+        self._execute("DELETE FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+
+class AsyncStorage:
+    """Асинхронная обёртка над Storage для обработчиков на asyncio.
+
+    Все вызовы выполняются в отдельном потоке хранилища: запись на диск и
+    запросы к SQLite не блокируют цикл событий, а соединение SQLite
+    используется строго из одного потока.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+            finally:
+                metrics.observe("storage_seconds", time.perf_counter() - started, op=name)
+
+        return call
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.storage.close)
+        self._executor.shutdown()
+
+
+def open_storage(backend, json_path=DATABASE_FILE, sqlite_path=SQLITE_FILE, classes_dir=CLASSES_DIR,
+                 default_class=DEFAULT_CLASS):
+    if backend == "json":
+        return JsonStorage(json_path, classes_dir=classes_dir, default_class=default_class)
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path, classes_dir=classes_dir, default_class=default_class)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def migrate_json_to_sqlite(json_path=DATABASE_FILE, sqlite_path=SQLITE_FILE, classes_dir=CLASSES_DIR,
+                           default_class=DEFAULT_CLASS):
+    source = JsonStorage(json_path, classes_dir=classes_dir, default_class=default_class)
+    target = SqliteStorage(sqlite_path, classes_dir=classes_dir, default_class=default_class)
+    counts = dict.fromkeys(["classes", "users", "pending_users", "schedule", "homework", "feedback",
+                            "announcements", "homework_history", "broadcasts"], 0)
+    try:
+        for class_id in source.list_classes():
+            shard = source.shard(class_id)
+            target.add_class(class_id)
+            target_shard = target.shard(class_id)
+            data = dict(shard.data)
+            # Отвеченная обратная связь из архива журнала тоже нужна для поиска
+            data["feedback"] = sorted([*shard.journal.archived_feedback.values(), *shard.list_feedback()],
+                                      key=lambda item: item['id'])
+            # С номерами из журнала: повторная миграция не задвоит объявления
+            data["announcements"] = list(shard.journal.announcements)
+            data["homework_history"] = list(shard.journal.homework_history.values())
+            with target_shard.lock, target_shard.conn as conn:
+                conn.executemany("INSERT OR REPLACE INTO pending_users (user_id, name, surname) VALUES (?, ?, ?)",
+                                 [(user, info['name'], info['surname'])
+                                  for user, info in data["pending_users"].items()])
+                conn.executemany("INSERT OR REPLACE INTO schedule (day, lessons) VALUES (?, ?)",
+                                 [(day, json.dumps(lessons)) for day, lessons in data["schedule"].items()])
+                conn.executemany("INSERT OR REPLACE INTO homework (day, lesson, task) VALUES (?, ?, ?)",
+                                 [(day, lesson, task)
+                                  for day, lessons in data["homework"].items()
+                                  for lesson, task in lessons.items()])
+                # Не REPLACE: удаление и повторная вставка строки задвоили бы её в feedback_search
+                conn.executemany("INSERT INTO feedback (id, user_id, text, answered) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT (id) DO UPDATE SET answered = excluded.answered",
+                                 [(item['id'], item['user_id'], item['text'], int(item.get('answered', False)))
+                                  for item in data["feedback"]])
+                conn.executemany("INSERT OR IGNORE INTO announcements (id, text) VALUES (?, ?)",
+                                 [(item['id'], item['text']) for item in data["announcements"]])
+                conn.executemany("INSERT OR IGNORE INTO homework_history (id, date, day, lesson, task) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 [(item['id'], item['date'], item['day'], item['lesson'], item['task'])
+                                  for item in data["homework_history"]])
+            counts["classes"] += 1
+            for key, value in data.items():
+                counts[key] += len(value)
+
+        admins = set(source.data["admins"])
+        with target.lock, target.conn as conn:
+            conn.executemany("INSERT OR REPLACE INTO users (user_id, class_id, admin, reminder) VALUES (?, ?, ?, ?)",
+                             [(user, class_id, int(user in admins), source.data["reminders"].get(user))
+                              for user, class_id in source.data["users"].items()])
+            conn.executemany("INSERT OR REPLACE INTO pending (user_id, class_id) VALUES (?, ?)",
+                             list(source.data["pending"].items()))
+            conn.executemany("INSERT OR REPLACE INTO conversations (user_id, state, arg, expires) VALUES (?, ?, ?, ?)",
+                             source.list_conversations())
+            conn.executemany("INSERT OR REPLACE INTO broadcasts "
+                             "(id, text, admin_id, recipients, position, sent, failed, pruned) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(item['id'], item['text'], item['admin_id'], json.dumps(item['recipients']),
+                               item['position'], item['sent'], item['failed'], item['pruned'])
+                              for item in source.data["broadcasts"]])
+            # Номера новых рассылок продолжают нумерацию data.json
+            last_id = source.data["next_broadcast_id"] - 1
+            if conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'broadcasts'",
+                            (last_id,)).rowcount == 0 and last_id > 0:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('broadcasts', ?)", (last_id,))
+        counts["users"] = len(source.data["users"])
+        counts["broadcasts"] = len(source.data["broadcasts"])
+    finally:
+        source.close()
+        target.close()
+    return counts
@@ -0,0 +1,164 @@
+import datetime
+import json
+
+import pytest
+
+from router import ADMIN, MAX_CALLBACK_DATA, CallbackRouter, StaleCallback
+from search import InvertedIndex, parse_query, tokenize
+from storage import Journal
+from transfer import ImportFormatError, export_csv, export_json, parse_week_file
+
+
+def handler():
+    pass
+
+
+# Кнопки
+
+def test_router_escapes_and_converts_params():
+    router = CallbackRouter()
+    router.add("hwl:{day}:{number:int}", handler)
+    data = router.data("hwl", "день:1%#_", 3)
+    route, params = router.resolve(data)
+    assert route.handler is handler
+    assert params == {"day": "день:1%#_", "number": 3}
+
+
+def test_router_rejects_unknown_and_malformed_data():
+    router = CallbackRouter()
+    router.add("ap:{class_id}:{user_id:int}", handler, ADMIN)
+    assert router.resolve("zz:1") == (None, {})
+    assert router.resolve("ap:основной") == (None, {})
+    assert router.resolve("ap:основной:abc") == (None, {})
+    with pytest.raises(TypeError):
+        router.data("ap", "основной")
+
+
+def test_router_digests_long_values():
+    router = CallbackRouter()
+    router.add("cls:{name}:{page:int}", handler)
+    name = "очень длинное название класса " * 3
+    data = router.data("cls", name, 2)
+    assert len(data.encode()) <= MAX_CALLBACK_DATA
+    assert router.resolve(data)[1] == {"name": name, "page": 2}
+
+
+def test_router_forgets_least_recently_used_digest():
+    router = CallbackRouter(max_digests=2)
+    router.add("cls:{name}", handler)
+    first, second = (router.data("cls", f"{i} " + "класс" * 20) for i in range(2))
+    router.resolve(first)  # first использовали последним, поэтому выбывает second
+    third = router.data("cls", "2 " + "класс" * 20)
+    assert router.resolve(first)[1] == {"name": "0 " + "класс" * 20}
+    assert router.resolve(third)[1] == {"name": "2 " + "класс" * 20}
+    with pytest.raises(StaleCallback):
+        router.resolve(second)
+
+
+# Файлы расписания и ДЗ
+
+SCHEDULE = {"понедельник": ["математика", "русский язык"], "вторник": ["физика"]}
+HOMEWORK = {"понедельник": {"математика": "стр. 12, упр. 5; \"задача\" 3"}}
+
+
+@pytest.mark.parametrize("filename, export", [("week.csv", export_csv), ("week.json", export_json)])
+def test_export_round_trip(filename, export):
+    assert parse_week_file(filename, export(SCHEDULE, HOMEWORK)) == (SCHEDULE, HOMEWORK)
+
+
+def test_parse_csv_from_excel():
+    content = "раздел;день;урок;дз\r\nрасписание;Понедельник;математика;\r\nдз;понедельник;Математика;стр. 5\r\n"
+    schedule, homework = parse_week_file("week.csv", content.encode("cp1251"))
+    assert schedule == {"понедельник": ["математика"]}
+    assert homework == {"понедельник": {"математика": "стр. 5"}}
+
+
+def test_parse_reports_every_error():
+    content = "раздел,день,урок,дз\nрасписание,понедельник,,\nдз,день,математика,\nоценки,вторник,физика,5\n"
+    with pytest.raises(ImportFormatError) as error:
+        parse_week_file("week.csv", content.encode())
+    assert len(error.value.errors) == 4
+    with pytest.raises(ImportFormatError):
+        parse_week_file("week.json", json.dumps({"schedule": {"понедельник": "математика"}}).encode())
+
+
+# Поиск
+
+TODAY = datetime.date(2026, 10, 18)
+
+
+def test_parse_query_dates():
+    assert parse_query("Математика 01.09-15.09", TODAY) == (["математика"], "2026-09-01", "2026-09-15")
+    # Дата без года ещё не наступила — значит, прошлый год
+    assert parse_query("физика 20.12", TODAY) == (["физика"], "2025-12-20", "2025-12-20")
+    assert parse_query("05.01.25 01.12.2024", TODAY) == ([], "2024-12-01", "2025-01-05")
+    assert parse_query("упр 5", TODAY) == (["упр", "5"], None, None)
+
+
+def test_parse_query_rejects_bad_dates():
+    with pytest.raises(ValueError):
+        parse_query("31.02", TODAY)
+    with pytest.raises(ValueError):
+        parse_query("01.09 02.09 03.09", TODAY)
+
+
+def test_inverted_index_prefix_search():
+    index = InvertedIndex()
+    index.add(1, "Математика: стр. 12")
+    index.add(2, "математике повторить")
+    index.add(3, "русский язык, стр. 40")
+    assert index.search(tokenize("матем")) == {1, 2}
+    assert index.search(tokenize("матем стр")) == {1}
+    assert index.search(tokenize("стр")) == {1, 3}
+    assert index.search(tokenize("физика")) == set()
+    assert index.search([]) == set()
+
+
+# Журнал
+
+def test_journal_replay(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.add_feedback(5, "когда контрольная?")
+    journal.add_feedback(6, "спасибо")
+    journal.mark_answered(1, 1)
+    journal.add_announcement("собрание в пятницу")
+    journal.add_homework("понедельник", "математика", "стр. 12")
+    journal.close()
+    # Запись, оборванная падением, отбрасывается
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"op": "feedback", "id": 3')
+
+    journal = Journal(path)
+    assert list(journal.unanswered) == [2]
+    assert journal.feedback[1]['answered']
+    assert journal.announcements == [{'id': 1, 'text': "собрание в пятницу"}]
+    assert [item['task'] for item in journal.homework_history.values()] == ["стр. 12"]
+    assert journal.add_feedback(7, "ещё вопрос") == 3
+    assert journal.appended == 6
+    journal.close()
+
+
+def test_journal_compaction_keeps_ids(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    for i in range(3):
+        journal.add_feedback(5, f"вопрос {i}")
+        journal.add_announcement(f"объявление {i}")
+    journal.mark_answered(1, 2)
+    journal.add_homework("вторник", "физика", "параграф 3")
+    # Отвеченная обратная связь, два старых объявления и история ДЗ
+    assert journal.compact(keep_announcements=1) == 5
+    assert journal.appended == 0
+    journal.close()
+
+    journal = Journal(path)
+    assert journal.appended == 0
+    assert list(journal.unanswered) == [3]
+    assert sorted(journal.archived_feedback) == [1, 2]
+    assert journal.announcements == [{'id': 3, 'text': "объявление 2"}]
+    assert journal.homework_index.search(["физ"]) == {1}
+    assert journal.add_feedback(5, "новый вопрос") == 4
+    assert journal.add_announcement("новое объявление") == 4
+    assert journal.compact() == 0
+    journal.close()
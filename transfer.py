@@ -0,0 +1,157 @@
+"""Загрузка и выгрузка расписания и ДЗ класса файлом (CSV или JSON).
+
+CSV — по строке на урок расписания или на задание:
+
+    раздел,день,урок,дз
+    расписание,понедельник,математика,
+    расписание,понедельник,русский,
+    дз,понедельник,математика,стр. 12 упр. 5
+
+JSON — {"schedule": {"понедельник": ["математика", ...]},
+        "homework": {"понедельник": {"математика": "стр. 12 упр. 5"}}}
+"""
+import csv
+import io
+import json
+
+from reminders import WEEKDAYS
+
+CSV_HEADER = ["раздел", "день", "урок", "дз"]
+SCHEDULE_SECTION = "расписание"
+HOMEWORK_SECTION = "дз"
+MAX_ERRORS = 10  # Сколько ошибок файла показывать админу
+
+
+class ImportFormatError(ValueError):
+    """Файл не прошёл проверку; errors — понятные админу описания ошибок."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def _decode(content):
+    # Excel сохраняет CSV в UTF-8 с BOM или в cp1251
+    try:
+        return content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return content.decode("cp1251")
+
+
+def _check_day(day, where, errors):
+    day = str(day).strip().lower()
+    if day not in WEEKDAYS:
+        errors.append(f"{where}: неизвестный день недели '{day}'")
+    return day
+
+
+def _parse_csv(text, errors):
+    schedule, homework = {}, {}
+    # По заголовку угадывается только разделитель: кавычек в нём нет, и остальные
+    # параметры Sniffer (doublequote) сломали бы ДЗ с кавычками
+    try:
+        delimiter = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;\t").delimiter
+    except csv.Error:
+        delimiter = ","
+    rows = csv.reader(io.StringIO(text), delimiter=delimiter)
+    header = [cell.strip().lower() for cell in next(rows, [])]
+    if header != CSV_HEADER:
+        errors.append(f"Первая строка должна быть: {','.join(CSV_HEADER)}")
+        return schedule, homework
+
+    for line, row in enumerate(rows, start=2):
+        row = [cell.strip() for cell in row]
+        if not any(row):
+            continue
+        if len(row) > len(CSV_HEADER):
+            errors.append(f"Строка {line}: больше {len(CSV_HEADER)} столбцов")
+            continue
+        section, day, lesson, task = row + [""] * (len(CSV_HEADER) - len(row))
+        day = _check_day(day, f"Строка {line}", errors)
+        if not lesson:
+            errors.append(f"Строка {line}: не указан урок")
+        elif section.lower() == SCHEDULE_SECTION:
+            schedule.setdefault(day, []).append(lesson)
+        elif section.lower() == HOMEWORK_SECTION:
+            if not task:
+                errors.append(f"Строка {line}: пустое ДЗ")
+            homework.setdefault(day, {})[lesson.lower()] = task
+        else:
+            errors.append(f"Строка {line}: раздел должен быть '{SCHEDULE_SECTION}' или '{HOMEWORK_SECTION}'")
+    return schedule, homework
+
+
+def _parse_json(text, errors):
+    schedule, homework = {}, {}
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        errors.append(f"Неверный JSON: {e}")
+        return schedule, homework
+    if not isinstance(data, dict) or not set(data) <= {"schedule", "homework"}:
+        errors.append('Ожидается объект с полями "schedule" и/или "homework"')
+        return schedule, homework
+
+    raw_schedule = data.get("schedule", {})
+    if not isinstance(raw_schedule, dict):
+        errors.append('"schedule" должен быть объектом: день -> список уроков')
+        raw_schedule = {}
+    for day, lessons in raw_schedule.items():
+        where = f"schedule.{day}"
+        day = _check_day(day, where, errors)
+        if not isinstance(lessons, list) or not all(isinstance(lesson, str) and lesson.strip() for lesson in lessons):
+            errors.append(f"{where}: ожидается список названий уроков")
+            continue
+        schedule[day] = [lesson.strip() for lesson in lessons]
+
+    raw_homework = data.get("homework", {})
+    if not isinstance(raw_homework, dict):
+        errors.append('"homework" должен быть объектом: день -> {урок: ДЗ}')
+        raw_homework = {}
+    for day, tasks in raw_homework.items():
+        where = f"homework.{day}"
+        day = _check_day(day, where, errors)
+        if not isinstance(tasks, dict) or not all(isinstance(task, str) and task.strip() for task in tasks.values()):
+            errors.append(f"{where}: ожидается объект урок -> текст ДЗ")
+            continue
+        homework.setdefault(day, {}).update(
+            {lesson.strip().lower(): task.strip() for lesson, task in tasks.items()})
+    return schedule, homework
+
+
+def parse_week_file(filename, content):
+    """(расписание, ДЗ) из содержимого файла. Формат определяется по расширению
+    (.json, иначе CSV). Если в файле есть ошибки, бросает ImportFormatError
+    со всеми найденными ошибками — частично файл не загружается."""
+    errors = []
+    try:
+        text = _decode(content)
+    except UnicodeDecodeError:
+        raise ImportFormatError(["Не удалось прочитать файл: сохраните его в кодировке UTF-8"])
+    if filename.lower().endswith(".json"):
+        schedule, homework = _parse_json(text, errors)
+    else:
+        schedule, homework = _parse_csv(text, errors)
+    if not errors and not schedule and not homework:
+        errors.append("В файле нет ни расписания, ни ДЗ")
+    if errors:
+        raise ImportFormatError(errors)
+    return schedule, homework
+
+
+def export_json(schedule, homework):
+    return json.dumps({"schedule": schedule, "homework": homework}, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def export_csv(schedule, homework):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(CSV_HEADER)
+    for day, lessons in schedule.items():
+        for lesson in lessons:
+            writer.writerow([SCHEDULE_SECTION, day, lesson.strip(), ""])
+    for day, tasks in homework.items():
+        for lesson, task in tasks.items():
+            writer.writerow([HOMEWORK_SECTION, day, lesson, task])
+    # BOM, чтобы Excel открыл кириллицу без вопросов о кодировке
+    return output.getvalue().encode("utf-8-sig")